@@ -1,6 +1,26 @@
 export PHONE_BOOK_TEST=1
-rm phonebook.db
+export PHONE_BOOK_REPLICA_URL=http://localhost:8002/
+#short enough for the tests to time a request out
+export PHONE_BOOK_READ_TIMEOUT=2
+for PHONE_BOOK_MODE in threaded asyncio prefork reuseport single; do
+	export PHONE_BOOK_MODE
+	rm -f phonebook.db phonebook.db-wal phonebook.db-shm phonebook-*-of-*.db*
+	python3 phonebookd.py &
+	sleep 1
+	PHONE_BOOK_REPLICA=1 PHONE_BOOK_REPLICA_POLL=0.1 PHONE_BOOK_PORT=8002 python3 phonebookd.py &
+	sleep 1
+	python3 phonebook-tests.py
+	kill $(jobs -p)
+	wait
+done
+#once more with the entries split across shards, which replicas don't serve, writes
+#group committed, every request profiled and slow queries logged
+export PHONE_BOOK_MODE=threaded PHONE_BOOK_SHARDS=4 PHONE_BOOK_DURABILITY=group PHONE_BOOK_PROFILE_SAMPLE=1 PHONE_BOOK_SLOW_QUERY_MS=0.1
+unset PHONE_BOOK_REPLICA_URL
+rm -f phonebook.db phonebook.db-wal phonebook.db-shm phonebook-*-of-*.db*
 python3 phonebookd.py &
 sleep 1
 python3 phonebook-tests.py
-kill %%
+kill $(jobs -p)
+wait
+rm -f phonebook-*-of-*.db*
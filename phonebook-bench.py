@@ -0,0 +1,468 @@
+import argparse, json, os, sys
+import http.client, multiprocessing, random, socket, sqlite3
+import subprocess, tempfile, time, tracemalloc
+
+HOST = "localhost"
+PORT = 8001
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "phonebookd.py")
+
+def start_server(database, env={}):
+	environ = dict(os.environ, PHONE_BOOK_TEST="1", PHONE_BOOK_PORT=str(PORT), PHONE_BOOK_DATABASE=database)
+	environ.update(env)
+	proc = subprocess.Popen([sys.executable, DAEMON], env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	deadline = time.time() + 30
+	while time.time() < deadline:
+		try:
+			socket.create_connection((HOST, PORT), timeout=1).close()
+			return proc
+		except OSError:
+			time.sleep(0.01)
+	proc.kill()
+	raise RuntimeError("phonebookd.py did not start")
+
+def migrated(database, timeout=600):
+	#waits for the server's background migrations to bring the schema up to date
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	db = sqlite3.connect(database, timeout=30)
+	try:
+		deadline = time.time() + timeout
+		while db.execute("PRAGMA user_version;").fetchone()[0] < phonebookd.migrations.latest:
+			if time.time() > deadline:
+				raise RuntimeError("phonebookd.py did not finish migrating")
+			time.sleep(0.01)
+	finally:
+		db.close()
+
+def stop_server(proc):
+	proc.terminate()
+	try:
+		proc.wait(10)
+	except subprocess.TimeoutExpired:
+		proc.kill()
+		proc.wait()
+
+def name(i, length=7):
+	#a pseudo random but repeatable word so substrings are selective
+	n = i * 2654435761 % 26 ** length
+	letters = []
+	for j in range(length):
+		(n, letter) = divmod(n, 26)
+		letters.append(chr(ord("a") + letter))
+	return "".join(letters).capitalize()
+
+def seed(database, rows, shards=1):
+	#goes straight to the tables the server has already created, each entry to its shard
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	layout = phonebookd.Shards(database, shards, 1)
+	dbs = [sqlite3.connect(path, timeout=30) for path in layout.files]
+	for start in range(0, rows, 100000):
+		parts = [[] for db in dbs]
+		for i in range(start, min(rows, start + 100000)):
+			parts[layout.owner(name(i))].append((name(i), name(i + rows, 5), "0181%07d" % i, ""))
+		for (db, part) in zip(dbs, parts):
+			db.executemany("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?);", part)
+			db.commit()
+	for db in dbs:
+		db.close()
+
+def request(method, path, body=None):
+	conn = http.client.HTTPConnection(HOST, PORT, timeout=60)
+	conn.request(method, path, body)
+	r = conn.getresponse()
+	r.read()
+	conn.close()
+	return r.status
+
+def client(args):
+	(method, path, body, duration) = args
+	count = 0
+	deadline = time.time() + duration
+	while time.time() < deadline:
+		request(method, path, body)
+		count += 1
+	return count
+
+def drive(clients, duration, method="GET", path="/", body=None):
+	with multiprocessing.Pool(clients) as p:
+		counts = p.map(client, [(method, path, body, duration)] * clients)
+	return sum(counts) / duration
+
+def scaling(args):
+	results = []
+	for workers in args.workers:
+		with tempfile.TemporaryDirectory() as tmp:
+			database = os.path.join(tmp, "phonebook.db")
+			proc = start_server(database, {"PHONE_BOOK_MODE": args.mode, "PHONE_BOOK_WORKERS": str(workers)})
+			try:
+				seed(database, args.rows)
+				rps = drive(args.clients, args.duration)
+			finally:
+				stop_server(proc)
+		#against the first worker count, linear scaling across cores is speedup == workers / args.workers[0]
+		speedup = rps / results[0]["requests_per_sec"] if results else 1.0
+		results.append({"mode": args.mode, "workers": workers, "cores": os.cpu_count(), "rows": args.rows,
+			"requests_per_sec": round(rps, 1), "speedup": round(speedup, 2)})
+		print("%s workers=%d: %.1f req/s, %.2fx" % (args.mode, workers, rps, speedup), file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def timed(method, path, body=None):
+	start = time.perf_counter()
+	request(method, path, body)
+	return time.perf_counter() - start
+
+def search(args):
+	results = []
+	for rows in args.rows:
+		with tempfile.TemporaryDirectory() as tmp:
+			database = os.path.join(tmp, "phonebook.db")
+			proc = start_server(database)
+			migrated(database)
+			stop_server(proc)
+			seed(database, rows)
+			#fragments from the middle of names that exist
+			terms = [json.dumps({"surname": name(i * 7919 % rows)[2:6]}) for i in range(args.queries)]
+			for engine in ("like", "fts"):
+				proc = start_server(database, {"PHONE_BOOK_SEARCH": engine})
+				try:
+					times = sorted(timed("POST", "/search", term) for term in terms)
+				finally:
+					stop_server(proc)
+				median = times[len(times) // 2] * 1000
+				results.append({"engine": engine, "rows": rows, "median_ms": round(median, 3)})
+				print("%s rows=%d: %.3f ms" % (engine, rows, median), file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def encode(args):
+	#in process, the server's own encoders against a plain json.dumps of dicts
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	db = sqlite3.connect(":memory:")
+	db.execute("CREATE TABLE phonebook (surname TEXT NOT NULL, firstname TEXT NOT NULL, number TEXT NOT NULL, address TEXT NOT NULL)")
+	db.executemany("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?);",
+		((name(i), name(i + args.rows, 5), "0181%07d" % i, "") for i in range(args.rows)))
+	sql = "SELECT surname, firstname, number, address FROM phonebook;"
+	def dicts():
+		return bytes(json.dumps([{"surname": row[0], "firstname": row[1], "number": row[2], "address": row[3]} for row in db.execute(sql)]), "utf-8")
+	encoders = [("json.dumps", dicts)]
+	for backend in ("stdlib", "orjson"):
+		if backend == "orjson" and not phonebookd.orjson:
+			continue
+		def rows(backend=backend):
+			phonebookd.JSON = backend
+			return phonebookd.query_rows(db, sql)
+		encoders.append((backend, rows))
+	results = []
+	for (encoder, func) in encoders:
+		best = min(timed_call(func) for i in range(args.repeat)) * 1000
+		results.append({"encoder": encoder, "rows": args.rows, "ms": round(best, 3)})
+		print("%s rows=%d: %.3f ms" % (encoder, args.rows, best), file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def replica(args):
+	#in process, a replica's snapshot against queries on the database it was loaded from
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	results = []
+	for rows in args.rows:
+		with tempfile.TemporaryDirectory() as tmp:
+			database = os.path.join(tmp, "phonebook.db")
+			db = sqlite3.connect(database)
+			db.execute("CREATE TABLE phonebook (surname TEXT NOT NULL, firstname TEXT NOT NULL, number TEXT NOT NULL, address TEXT NOT NULL)")
+			db.execute("CREATE INDEX phonebook_surname ON phonebook (surname)")
+			db.commit()
+			seed(database, rows)
+			load = timed_call(lambda: phonebookd.Snapshot.load(db))
+			tracemalloc.start()
+			snapshot = phonebookd.Snapshot.load(db)
+			(size, peak) = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			terms = [name(i * 7919 % rows)[2:6] for i in range(args.queries)]
+			sql = "SELECT surname, firstname, number, address FROM phonebook WHERE surname LIKE '%' || ? || '%' ORDER BY surname ASC, rowid ASC;"
+			result = {"rows": rows, "load_s": round(load, 3), "bytes_per_entry": round(size / rows, 1), "peak_bytes_per_entry": round(peak / rows, 1),
+				"list_ms": round(min(timed_call(snapshot.listing) for i in range(3)) * 1000, 3),
+				"sqlite_list_ms": round(min(timed_call(lambda: phonebookd.query_rows(db, "SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;")) for i in range(3)) * 1000, 3),
+				"search_ms": round(sorted(timed_call(lambda: snapshot.find(term)) for term in terms)[len(terms) // 2] * 1000, 3),
+				"sqlite_search_ms": round(sorted(timed_call(lambda: phonebookd.query_rows(db, sql, (term,))) for term in terms)[len(terms) // 2] * 1000, 3)}
+			db.close()
+		results.append(result)
+		print("rows=%d: %.1f bytes/entry, loaded in %.3fs" % (rows, result["bytes_per_entry"], load), file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def suggest(args):
+	#in process, prefix lookups and incremental updates on the server's suggestion lists
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	results = []
+	for rows in args.rows:
+		s = phonebookd.Suggestions(None)
+		pairs = [(name(i), name(i + rows, 5)) for i in range(rows)]
+		start = time.perf_counter()
+		(s.keys, s.counts) = s.build(pairs)
+		build = time.perf_counter() - start
+		prefixes = [name(i * 7919 % rows)[:args.length] for i in range(args.queries)]
+		lookups = sorted(timed_call(lambda: s.lookup(prefix, 10)) for prefix in prefixes)
+		updates = sorted(timed_call(lambda: s.apply(s.keys, s.counts, (), ((name(rows + i), "Bench"),))) for i in range(args.queries))
+		result = {"rows": rows, "prefix_length": args.length, "build_s": round(build, 3),
+			"lookup_p50_us": round(lookups[len(lookups) // 2] * 1000000, 1), "lookup_p99_us": round(lookups[len(lookups) * 99 // 100] * 1000000, 1),
+			"update_p50_us": round(updates[len(updates) // 2] * 1000000, 1), "update_p99_us": round(updates[len(updates) * 99 // 100] * 1000000, 1)}
+		results.append(result)
+		print("rows=%d: lookup p50 %.1f us, update p50 %.1f us" % (rows, result["lookup_p50_us"], result["update_p50_us"]), file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def compression(args):
+	#in process, bytes on the wire and cpu time for a listing with each encoding,
+	#compressed whole as when cached and a batch at a time as when streamed
+	sys.path.insert(0, os.path.dirname(DAEMON))
+	import phonebookd
+	encodings = ["identity", "gzip"] + (["br"] if phonebookd.brotli else [])
+	results = []
+	for rows in args.rows:
+		db = sqlite3.connect(":memory:")
+		db.execute("CREATE TABLE phonebook (surname TEXT NOT NULL, firstname TEXT NOT NULL, number TEXT NOT NULL, address TEXT NOT NULL)")
+		db.executemany("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?);",
+			((name(i), name(i + rows, 5), "0181%07d" % i, "") for i in range(rows)))
+		listing = phonebookd.query_rows(db, "SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;")
+		batches = [listing[i:i + 64 * 1024] for i in range(0, len(listing), 64 * 1024)]
+		db.close()
+		for encoding in encodings:
+			if encoding == "identity":
+				whole = lambda: listing
+				stream = lambda: b"".join(batches)
+			else:
+				whole = lambda: phonebookd.compress(listing, encoding)
+				stream = lambda: b"".join(phonebookd.compress_stream((batch for batch in batches), encoding))
+			result = {"rows": rows, "encoding": encoding}
+			for (kind, func) in (("whole", whole), ("stream", stream)):
+				cpu = []
+				for i in range(args.repeat):
+					start = time.process_time()
+					data = func()
+					cpu.append(time.process_time() - start)
+				result[kind + "_bytes"] = len(data)
+				result[kind + "_cpu_ms"] = round(min(cpu) * 1000, 3)
+			result["ratio"] = round(len(listing) / result["whole_bytes"], 2)
+			results.append(result)
+			print("%s rows=%d: %d bytes, %.3f ms cpu, %d bytes streamed" % (encoding, rows, result["whole_bytes"], result["whole_cpu_ms"], result["stream_bytes"]),
+				file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def timed_call(func):
+	start = time.perf_counter()
+	func()
+	return time.perf_counter() - start
+
+def load_client(args):
+	#one process of the load mix, returns latencies and error counts by operation
+	(mix, duration, rows, client_id) = args
+	rng = random.Random(client_id)
+	ops = list(mix.keys())
+	weights = list(mix.values())
+	latencies = dict((op, []) for op in ops)
+	errors = dict((op, 0) for op in ops)
+	created = 0
+	deadline = time.time() + duration
+	while time.time() < deadline:
+		op = rng.choices(ops, weights)[0]
+		if op == "list":
+			(method, path, body) = ("GET", "/", None)
+		elif op == "page":
+			(method, path, body) = ("GET", "/?limit=100", None)
+		elif op == "search":
+			(method, path, body) = ("POST", "/search", json.dumps({"surname": name(rng.randrange(rows))[2:6]}))
+		else:
+			created += 1
+			entry = {"surname": name(rows + client_id * 10000000 + created), "firstname": "Load", "number": "0%d" % created}
+			(method, path, body) = ("POST", "/create", json.dumps(entry))
+		start = time.perf_counter()
+		try:
+			status = request(method, path, body)
+		except OSError:
+			status = 599
+		latencies[op].append(time.perf_counter() - start)
+		if status >= 500 or (op == "create" and status != 201):
+			errors[op] += 1
+	return(latencies, errors)
+
+def percentile(ordered, p):
+	if not ordered:
+		return None
+	return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3)
+
+def summarise(latencies, errors, duration):
+	ordered = sorted(latencies)
+	return {"count": len(ordered), "errors": errors, "requests_per_sec": round(len(ordered) / duration, 1),
+		"p50_ms": percentile(ordered, 50), "p95_ms": percentile(ordered, 95), "p99_ms": percentile(ordered, 99)}
+
+def version():
+	#so reports from different releases can be told apart
+	try:
+		return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(DAEMON),
+			capture_output=True, text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+def run_mix(env, rows, mix, clients, duration):
+	#a fresh server and database for one run of the mix
+	with tempfile.TemporaryDirectory() as tmp:
+		database = os.path.join(tmp, "phonebook.db")
+		proc = start_server(database, env)
+		try:
+			seed(database, rows, int(env.get("PHONE_BOOK_SHARDS", 1)))
+			with multiprocessing.Pool(clients) as p:
+				outcomes = p.map(load_client, [(mix, duration, rows, i) for i in range(clients)])
+		finally:
+			stop_server(proc)
+	ops = {}
+	everything = []
+	for op in mix:
+		latencies = [t for (l, e) in outcomes for t in l[op]]
+		everything += latencies
+		ops[op] = summarise(latencies, sum(e[op] for (l, e) in outcomes), duration)
+	total = summarise(everything, sum(ops[op]["errors"] for op in ops), duration)
+	return(ops, total)
+
+def durability(args):
+	results = []
+	for profile in args.profiles.split(","):
+		(ops, total) = run_mix({"PHONE_BOOK_DURABILITY": profile, "PHONE_BOOK_WORKERS": str(args.workers)}, args.rows, {"create": 1}, args.clients, args.duration)
+		results.append(dict(total, profile=profile, rows=args.rows, clients=args.clients))
+		print("%s: %.1f writes/s p50 %s ms p99 %s ms" % (profile, total["requests_per_sec"], total["p50_ms"], total["p99_ms"]), file=sys.stderr)
+	print(json.dumps(results, indent=4, sort_keys=True))
+
+def shards(args):
+	#create throughput with the entries split across each number of shards, every shard
+	#having a writer of its own
+	results = []
+	for count in args.shards:
+		env = {"PHONE_BOOK_SHARDS": str(count), "PHONE_BOOK_DURABILITY": args.durability, "PHONE_BOOK_MODE": args.mode, "PHONE_BOOK_WORKERS": str(args.workers)}
+		(ops, total) = run_mix(env, args.rows, {"create": 1}, args.clients, args.duration)
+		speedup = total["requests_per_sec"] / results[0]["requests_per_sec"] if results else 1.0
+		results.append(dict(total, shards=count, durability=args.durability, mode=args.mode, rows=args.rows, clients=args.clients, speedup=round(speedup, 2)))
+		print("shards=%d: %.1f writes/s p50 %s ms p99 %s ms, %.2fx" % (count, total["requests_per_sec"], total["p50_ms"], total["p99_ms"], speedup), file=sys.stderr)
+	print(json.dumps(results, indent=4, sort_keys=True))
+
+def load(args):
+	mix = {}
+	for part in args.mix.split(","):
+		(op, weight) = part.split("=")
+		if not op in ("list", "page", "search", "create"):
+			raise SystemExit("Unknown operation in mix: " + op)
+		if float(weight) > 0:
+			mix[op] = float(weight)
+	results = []
+	for rows in args.rows:
+		(ops, total) = run_mix({"PHONE_BOOK_MODE": args.mode, "PHONE_BOOK_WORKERS": str(args.workers)}, rows, mix, args.clients, args.duration)
+		results.append({"version": version(), "rows": rows, "mode": args.mode, "workers": args.workers, "clients": args.clients,
+			"duration": args.duration, "mix": mix, "ops": ops, "total": total})
+		print("rows=%d: %.1f req/s p50 %s ms p99 %s ms" % (rows, total["requests_per_sec"], total["p50_ms"], total["p99_ms"]), file=sys.stderr)
+	report = json.dumps(results, indent=4, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(report + "\n")
+	else:
+		print(report)
+
+def startup(args):
+	#a database from before schema versioning is brought up to date, the foreground
+	#migrations before the server listens and the rest once it is serving, after which
+	#starting is only a matter of checking the version
+	results = []
+	started = time.perf_counter()
+	subprocess.run([sys.executable, "-c", "pass"], check=True)
+	interpreter = time.perf_counter() - started
+	started = time.perf_counter()
+	subprocess.run([sys.executable, "-c", "import phonebookd"], cwd=os.path.dirname(DAEMON), check=True)
+	imported = time.perf_counter() - started - interpreter
+	for rows in args.rows:
+		with tempfile.TemporaryDirectory() as tmp:
+			database = os.path.join(tmp, "phonebook.db")
+			db = sqlite3.connect(database)
+			db.execute("CREATE TABLE phonebook (surname TEXT NOT NULL, firstname TEXT NOT NULL, number TEXT NOT NULL, address TEXT NOT NULL)")
+			db.close()
+			seed(database, rows)
+			started = time.perf_counter()
+			proc = start_server(database)
+			try:
+				upgrade = time.perf_counter() - started
+				migrated(database)
+				background = time.perf_counter() - started - upgrade
+			finally:
+				stop_server(proc)
+			starts = []
+			for i in range(args.repeat):
+				started = time.perf_counter()
+				stop_server(start_server(database))
+				starts.append(time.perf_counter() - started)
+		results.append({"rows": rows, "import_ms": round(imported * 1000, 1), "upgrade_ms": round(upgrade * 1000, 1),
+			"background_ms": round(background * 1000, 1), "start_ms": round(min(starts) * 1000, 1)})
+		print("rows=%d: upgraded and listening in %.3fs, migrated in the background in %.3fs, restarts in %.3fs" % (rows, upgrade, background, min(starts)),
+			file=sys.stderr)
+	print(json.dumps(results, indent=4))
+
+def int_list(text):
+	return [int(n) for n in text.split(",")]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmarks for phonebookd.py.")
+	commands = parser.add_subparsers(dest="command", required=True)
+	p = commands.add_parser("scaling", help="GET / requests/sec against the number of server workers")
+	p.add_argument("--mode", default="threaded", choices=["threaded", "prefork", "reuseport", "asyncio"])
+	p.add_argument("--workers", type=int_list, default=[1, 2, 4, 8])
+	p.add_argument("--clients", type=int, default=16)
+	p.add_argument("--rows", type=int, default=1000)
+	p.add_argument("--duration", type=float, default=5)
+	p.set_defaults(func=scaling)
+	p = commands.add_parser("search", help="surname search latency of the LIKE scan against the trigram index")
+	p.add_argument("--rows", type=int_list, default=[10000, 1000000, 10000000])
+	p.add_argument("--queries", type=int, default=50)
+	p.set_defaults(func=search)
+	p = commands.add_parser("load", help="latency percentiles and requests/sec of a mix of operations on seeded datasets")
+	p.add_argument("--rows", type=int_list, default=[10000, 100000, 1000000, 10000000])
+	p.add_argument("--mix", default="page=45,search=45,create=10", help="weights of list, page, search and create")
+	p.add_argument("--mode", default="threaded", choices=["threaded", "prefork", "reuseport", "asyncio"])
+	p.add_argument("--workers", type=int, default=8)
+	p.add_argument("--clients", type=int, default=16)
+	p.add_argument("--duration", type=float, default=10)
+	p.add_argument("--output", help="write the json report here instead of stdout")
+	p.set_defaults(func=load)
+	p = commands.add_parser("durability", help="create throughput and latency under each durability profile")
+	p.add_argument("--profiles", default="strict,wal,group")
+	p.add_argument("--rows", type=int, default=10000)
+	p.add_argument("--workers", type=int, default=8)
+	p.add_argument("--clients", type=int, default=16)
+	p.add_argument("--duration", type=float, default=10)
+	p.set_defaults(func=durability)
+	p = commands.add_parser("shards", help="create throughput and latency with the entries split across each number of shards")
+	p.add_argument("--shards", type=int_list, default=[1, 4, 16])
+	p.add_argument("--durability", default="strict", choices=["strict", "wal", "group"])
+	p.add_argument("--mode", default="threaded", choices=["threaded", "prefork", "reuseport", "asyncio"])
+	p.add_argument("--rows", type=int, default=10000)
+	p.add_argument("--workers", type=int, default=16)
+	p.add_argument("--clients", type=int, default=16)
+	p.add_argument("--duration", type=float, default=10)
+	p.set_defaults(func=shards)
+	p = commands.add_parser("replica", help="memory, load time, listing and search latency of a replica's snapshot")
+	p.add_argument("--rows", type=int_list, default=[100000, 1000000])
+	p.add_argument("--queries", type=int, default=20)
+	p.set_defaults(func=replica)
+	p = commands.add_parser("suggest", help="prefix lookup and update times of the suggestion lists")
+	p.add_argument("--rows", type=int_list, default=[100000, 1000000])
+	p.add_argument("--length", type=int, default=2, help="prefix length")
+	p.add_argument("--queries", type=int, default=1000)
+	p.set_defaults(func=suggest)
+	p = commands.add_parser("compression", help="bytes on the wire and cpu time of a listing with each content encoding")
+	p.add_argument("--rows", type=int_list, default=[1000, 100000, 1000000])
+	p.add_argument("--repeat", type=int, default=3)
+	p.set_defaults(func=compression)
+	p = commands.add_parser("encode", help="time to query and encode rows as a json listing")
+	p.add_argument("--rows", type=int, default=100000)
+	p.add_argument("--repeat", type=int, default=5)
+	p.set_defaults(func=encode)
+	p = commands.add_parser("startup", help="time to import the module, upgrade an unversioned database and start up to date")
+	p.add_argument("--rows", type=int_list, default=[10000, 1000000])
+	p.add_argument("--repeat", type=int, default=5)
+	p.set_defaults(func=startup)
+	args = parser.parse_args()
+	args.func(args)
@@ -1,7 +1,11 @@
 import unittest
 import requests, json
+import contextlib, io, os, select, socket, sqlite3, threading, time
+import concurrent.futures, marshal, tempfile
 
 URL = "http://localhost:8000/"
+SHARDS = int(os.getenv('PHONE_BOOK_SHARDS', 1))
+READ_TIMEOUT = float(os.getenv('PHONE_BOOK_READ_TIMEOUT', 30))
 
 class PhoneBookTest(unittest.TestCase):
 
@@ -117,6 +121,17 @@ class PhoneBookTest(unittest.TestCase):
 		assert r.status_code == 409
 		assert r.text == "Duplicate entry."
 
+		#fields are text, anything else is refused before it's written
+		for field in ("surname", "firstname", "number", "address"):
+			entry = {"surname": "Ride", "firstname": "Sally", "number": "01818118187", "address": "Houston"}
+			entry[field] = 5
+			r = requests.post(URL + "create", data=json.dumps(entry))
+			assert r.status_code == 400
+			assert r.text == "Bad request data."
+		r = requests.get(URL)
+		assert r.status_code == 200
+		assert not [entry for entry in json.loads(r.text) if entry["surname"] == "Ride"]
+
 	def test_1_remove_entry(self):
 		#there is no key and you need to say the whole entry you want to delete exactly right
 		#delete an nonexistant entry
@@ -191,6 +206,17 @@ class PhoneBookTest(unittest.TestCase):
 		entry = {"surname": "Collins", "firstname": "Michael", "number": "01818118189", "address": "Other side of the moon."}
 		assert entry in backdata
 
+		#an update can't turn one entry into a copy of another
+		entry = {"surname": "Collins", "firstname": "Michael", "number": "01818118190", "address": ""}
+		text = json.dumps(entry)
+		r = requests.post(URL + "create", data=text)
+		assert r.status_code == 201
+		entry.update({"newsurname": "Collins", "newfirstname": "Michael", "newnumber": "01818118189", "newaddress": "Other side of the moon."})
+		text = json.dumps(entry)
+		r = requests.post(URL + "update", data=text)
+		assert r.status_code == 409
+		assert r.text == "Duplicate entry."
+
 		#invalidate an entry - thank you other applicant for leaving your code on github
 		entry = {"surname": "Collins", "firstname": "Michael", "number": "01818118189", "address": "Other side of the moon.",
 			"newsurname": ""}
@@ -211,6 +237,22 @@ class PhoneBookTest(unittest.TestCase):
 		assert r.status_code == 400
 		assert r.text == "Missing compulsory field."
 
+		#an address can be empty but not null
+		entry = {"surname": "Collins", "firstname": "Michael", "number": "01818118189", "address": "Other side of the moon.",
+			"newsurname": "Collins", "newfirstname": "Michael", "newnumber": "01818118189", "newaddress": None}
+		text = json.dumps(entry)
+		r = requests.post(URL + "update", data=text)
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+
+		#nor anything else that isn't text
+		entry = {"surname": "Collins", "firstname": "Michael", "number": "01818118189", "address": "Other side of the moon.",
+			"newsurname": 5, "newfirstname": "Michael", "newnumber": "01818118189", "newaddress": ""}
+		text = json.dumps(entry)
+		r = requests.post(URL + "update", data=text)
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+
 	def test_1_search_surname(self):
 		entry1 = {"surname": "Lovell", "firstname": "Jim", "number": "01818118190", "address": ""}
 		text = json.dumps(entry1)
@@ -255,20 +297,450 @@ class PhoneBookTest(unittest.TestCase):
 		assert r.status_code == 404
 		assert r.text == ""
 
-		#test a search on an unsupported field
+		#test a search on a field other than surname
 		entry = {"firstname": "Bracken"}
 		text = json.dumps(entry)
 		r = requests.post(URL + "search", data=text)
-		assert r.status_code == 400
-		assert r.text == "Missing compulsory field." or r.text == "Unsupported field."
+		assert r.status_code == 404
 
-		#test an entry including an unspported field
+		#test a search on more than one field
 		entry = {"surname": "Lovell", "firstname": "Jack"}
 		text = json.dumps(entry)
 		r = requests.post(URL + "search", data=text)
+		assert r.status_code == 404
+		entry = {"surname": "Lovell", "firstname": "mar"}
+		text = json.dumps(entry)
+		r = requests.post(URL + "search", data=text)
+		assert r.status_code == 200
+		assert json.loads(r.text) == [entry2]
+
+		#test an entry including an unspported field
+		entry = {"surname": "Lovell", "nickname": "Jack"}
+		text = json.dumps(entry)
+		r = requests.post(URL + "search", data=text)
 		assert r.status_code == 400
 		assert r.text == "Unsupported field."
 
+	def test_1_search_fields(self):
+		entries = [{"surname": "Aldrin", "firstname": "Buzz", "number": "01818118210", "address": "Tranquility Base"},
+			{"surname": "Armstrong", "firstname": "Neil", "number": "01818118211", "address": "Tranquility Base"},
+			{"surname": "Collins", "firstname": "Michael", "number": "01818118212", "address": "Columbia"}]
+		for entry in entries:
+			r = requests.post(URL + "create", data=json.dumps(entry))
+			assert r.status_code == 201
+
+		def search(**query):
+			r = requests.post(URL + "search", data=json.dumps(query))
+			return(r.status_code, json.loads(r.text) if r.status_code == 200 else None)
+
+		assert search(address={"exact": "Tranquility Base"}) == (200, entries[:2])
+		assert search(address={"exact": "tranquility base"}) == (404, None)
+		assert search(address={"prefix": "TRANQ"}, firstname="ei") == (200, entries[1:2])
+		assert search(number={"prefix": "0181811821"}, limit=2, offset=1) == (200, entries[1:3])
+		assert search(number={"substring": "8118212"}) == (200, entries[2:])
+
+		#the plan shows which index leads, the most selective of those which apply, which
+		#with shards is up to each one
+		if SHARDS == 1:
+			(status, plan) = search(surname={"prefix": "a"}, number={"exact": "01818118211"}, explain=True)
+			assert status == 200
+			assert plan["index"] == "phonebook_number_nocase"
+			assert [candidate["index"] for candidate in plan["candidates"]] == ["phonebook_number_nocase", "phonebook_surname_nocase"]
+			assert any("phonebook_number_nocase" in step for step in plan["plan"])
+
+		assert search(surname={"sounds like": "Aldrin"}) == (400, None)
+		assert search(surname="Aldrin", limit=0) == (400, None)
+		assert search(surname={"exact": ""}) == (400, None)
+
+	def test_1_list_pages(self):
+		for firstname in ("Pavel", "Alexei", "Valentina"):
+			text = json.dumps({"surname": "Tereshkova", "firstname": firstname, "number": "01818118197"})
+			r = requests.post(URL + "create", data=text)
+			assert r.status_code == 201
+		r = requests.get(URL)
+		assert r.status_code == 200
+		everything = json.loads(r.text)
+
+		#walking the pages gives back the whole listing in order
+		entries = []
+		params = {"limit": 2}
+		while True:
+			r = requests.get(URL, params=params)
+			assert r.status_code == 200
+			page = json.loads(r.text)
+			assert len(page["entries"]) <= 2
+			entries += page["entries"]
+			if page["after"] is None:
+				break
+			params["after"] = page["after"]
+		assert entries == everything
+
+		#so does streaming it
+		r = requests.get(URL, params={"stream": 1})
+		assert r.status_code == 200
+		assert json.loads(r.text) == everything
+
+		r = requests.get(URL, params={"limit": "lots"})
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+		r = requests.get(URL, params={"after": "Tereshkova"})
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+
+	def test_1_bulk(self):
+		ops = [{"op": "create", "surname": "Leonov", "firstname": "Alexei", "number": "01818118198"},
+			{"op": "create", "surname": "Leonov", "firstname": "Alexei", "number": "01818118198"},
+			{"op": "create", "surname": "Titov", "firstname": "Gherman"},
+			{"op": "update", "surname": "Leonov", "firstname": "Alexei", "number": "01818118198", "address": "",
+				"newsurname": "Leonov", "newfirstname": "Alexei", "newnumber": "01818118199", "newaddress": "Voskhod 2"},
+			{"op": "remove", "surname": "Titov", "firstname": "Gherman", "number": "01818118198", "address": ""},
+			{"op": "launch"},
+			"Titov"]
+		expected = [{"status": 201}, {"status": 409, "error": "Duplicate entry."}, {"status": 400, "error": "Missing compulsory field."},
+			{"status": 201}, {"status": 404, "error": "No such entry."}, {"status": 404, "error": "Unknown action."},
+			{"status": 400, "error": "Bad request data."}]
+		r = requests.post(URL + "bulk", data=json.dumps(ops))
+		assert r.status_code == 200
+		assert json.loads(r.text) == expected
+		r = requests.get(URL)
+		assert {"surname": "Leonov", "firstname": "Alexei", "number": "01818118199", "address": "Voskhod 2"} in json.loads(r.text)
+
+		#the same again as ndjson in batches of two
+		ops[0]["number"] = ops[1]["number"] = ops[3]["number"] = "01818118200"
+		ops[3]["newnumber"] = "01818118201"
+		r = requests.post(URL + "bulk?batch=2", data="\n".join(json.dumps(op) for op in ops))
+		assert r.status_code == 200
+		assert json.loads(r.text) == expected
+
+		r = requests.post(URL + "bulk", data="[")
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+
+		#a field that isn't text is a bad item, not a failed request
+		ops = [{"op": "create", "surname": "Leonov", "firstname": {"name": "Alexei"}, "number": "01818118202"},
+			{"op": "remove", "surname": "Leonov", "firstname": "Alexei", "number": ["01818118199"], "address": "Voskhod 2"},
+			{"op": "update", "surname": "Leonov", "firstname": "Alexei", "number": "01818118199", "address": "Voskhod 2",
+				"newsurname": "Leonov", "newfirstname": "Alexei", "newnumber": "01818118199", "newaddress": {}},
+			{"op": "create", "surname": "Leonov", "firstname": "Alexei", "number": "01818118202"}]
+		r = requests.post(URL + "bulk", data=json.dumps(ops))
+		assert r.status_code == 200
+		assert json.loads(r.text) == [{"status": 400, "error": "Bad request data."}] * 3 + [{"status": 201}]
+
+	def test_1_import_export(self):
+		entries = [{"surname": "Savitskaya", "firstname": "Svetlana", "number": "01818118210", "address": "Soyuz T-7"},
+			{"surname": "Savitskaya", "firstname": "Svetlana, \"Sveta\"", "number": "01818118211", "address": "Line one\nLine two"}]
+		data = "\n".join(json.dumps(entry) for entry in entries) + '\n\n{"surname": "Savitskaya"}\nSavitskaya\n' + json.dumps(entries[0])
+		r = requests.post(URL + "import", data=data)
+		assert r.status_code == 200
+		report = json.loads(r.text)
+		assert (report["read"], report["imported"], report["duplicates"], report["invalid"]) == (5, 2, 1, 2)
+		assert report["errors"] == [{"entry": 3, "status": 400, "error": "Missing compulsory field."}, {"entry": 4, "status": 400, "error": "Bad request data."}]
+		r = requests.post(URL + "import", data=json.dumps(dict(entries[0], address={"craft": "Soyuz T-7"})) + "\n" + json.dumps(dict(entries[0], number="01818118240")))
+		assert r.status_code == 200
+		report = json.loads(r.text)
+		assert (report["read"], report["imported"], report["invalid"]) == (2, 1, 1)
+		assert report["errors"] == [{"entry": 1, "status": 400, "error": "Bad request data."}]
+
+		r = requests.get(URL + "export")
+		assert r.status_code == 200
+		assert r.headers["Content-type"] == "application/x-ndjson"
+		exported = [json.loads(line) for line in r.text.splitlines()]
+		assert all(entry in exported for entry in entries)
+
+		#the same through csv, where they are all dupes now
+		r = requests.get(URL + "export", params={"format": "csv"})
+		assert r.status_code == 200
+		assert r.text.startswith("surname,firstname,number,address\r\n")
+		r = requests.post(URL + "import?format=csv", data=r.text.encode("utf-8"))
+		assert r.status_code == 200
+		report = json.loads(r.text)
+		assert (report["read"], report["imported"], report["duplicates"], report["invalid"]) == (len(exported), 0, len(exported), 0)
+
+		r = requests.get(URL + "export", params={"format": "xml"})
+		assert r.status_code == 400
+		assert r.text == "Unsupported format."
+
+		#imports are read as they go, so they can be longer than any other body and
+		#arrive bit by bit, and a client which stops part way gets what it sent imported
+		s = socket.create_connection(("localhost", 8000), timeout=10)
+		s.sendall(b"POST /import HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1000000000000\r\n\r\n")
+		for entry in entries:
+			s.sendall(json.dumps(dict(entry, surname="Serova")).encode() + b"\n")
+			time.sleep(0.1)
+		s.shutdown(socket.SHUT_WR)
+		response = b""
+		while True:
+			chunk = s.recv(65536)
+			if not chunk:
+				break
+			response += chunk
+		s.close()
+		(head, body) = response.split(b"\r\n\r\n", 1)
+		assert head.startswith(b"HTTP/1.1 200 ")
+		assert b"Connection: close" in head
+		assert (json.loads(body)["read"], json.loads(body)["imported"]) == (2, 2)
+
+	@unittest.skipUnless(SHARDS == 1, "sequence numbers are per shard, see test_1_shards")
+	def test_1_changes(self):
+		r = requests.get(URL + "changes")
+		assert r.status_code == 200
+		last = json.loads(r.text)["last"]
+
+		entry = {"surname": "Komarov", "firstname": "Vladimir", "number": "01818118220", "address": ""}
+		update = dict(entry, newsurname="Komarov", newfirstname="Vladimir", newnumber="01818118221", newaddress="Soyuz 1")
+		assert requests.post(URL + "create", data=json.dumps(entry)).status_code == 201
+		assert requests.post(URL + "update", data=json.dumps(update)).status_code == 201
+		r = requests.get(URL + "changes", params={"since": last})
+		assert r.status_code == 200
+		found = json.loads(r.text)
+		assert found == {"changes": [dict(entry, seq=last + 1, op="create"), dict(update, seq=last + 2, op="update")], "last": last + 2}
+		r = requests.get(URL + "changes", params={"since": last, "limit": 1})
+		assert json.loads(r.text) == {"changes": found["changes"][:1], "last": last + 1}
+
+		#nothing yet, then a remove while waiting. Where the remove needs the waiting
+		#request's worker that gives up with nothing and the client asks again.
+		last += 2
+		r = requests.get(URL + "changes", params={"since": last, "wait": 0.1})
+		assert json.loads(r.text) == {"changes": [], "last": last}
+		remove = {"surname": "Komarov", "firstname": "Vladimir", "number": "01818118221", "address": "Soyuz 1"}
+		timer = threading.Timer(0.2, lambda: requests.post(URL + "remove", data=json.dumps(remove)))
+		timer.start()
+		start = time.time()
+		found = []
+		while not found and time.time() - start < 5:
+			r = requests.get(URL + "changes", params={"since": last, "wait": 10})
+			assert r.status_code == 200
+			found = json.loads(r.text)["changes"]
+		timer.join()
+		assert found == [dict(remove, seq=last + 1, op="remove")]
+
+		#streamed as events, for half a second
+		r = requests.get(URL + "changes", params={"since": last, "wait": 0.5}, headers={"Accept": "text/event-stream"}, stream=True)
+		assert r.status_code == 200
+		assert r.headers["Content-type"] == "text/event-stream"
+		lines = r.iter_lines(decode_unicode=True)
+		assert next(lines) == "retry: 1000"
+		assert next(lines) == ""
+		assert next(lines) == "id: %d" % (last + 1)
+		assert next(lines) == "event: change"
+		assert json.loads(next(lines)[len("data: "):]) == dict(remove, seq=last + 1, op="remove")
+		r.close()
+
+		#waiting clients never hold up anyone else, however many of them there are
+		workers = int(os.getenv('PHONE_BOOK_WORKERS', 8))
+		last += 1
+		polls = [threading.Thread(target=requests.get, args=(URL + "changes",), kwargs={"params": {"since": last, "wait": 2}}) for i in range(workers)]
+		for poll in polls:
+			poll.start()
+		time.sleep(0.5)
+		r = requests.get(URL)
+		assert r.status_code == 200
+		assert r.elapsed.total_seconds() < 1
+		for poll in polls:
+			poll.join()
+
+		r = requests.get(URL + "changes", params={"since": last + 1000000})
+		assert r.status_code == 410
+		assert r.text == "Changes no longer available."
+		r = requests.get(URL + "changes", params={"since": "x"})
+		assert r.status_code == 400
+
+	def test_1_stream_connections(self):
+		#in process, streams which clients are slow to read don't take readers from the
+		#pool, so however many of them there are other reads still get one
+		import phonebookd
+		sql = "SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;"
+		streams = [phonebookd.PhoneBook.stream_json(sql, ()) for i in range(phonebookd.POOL_SIZE + 1)]
+		for stream in streams:
+			assert next(stream).startswith(b"[")
+		listed = []
+		reader = threading.Thread(target=lambda: listed.append(phonebookd.PhoneBook.list_rows()), daemon=True)
+		reader.start()
+		reader.join(5)
+		for stream in streams:
+			stream.close()
+		assert listed and listed[0][0] == 200
+
+	def test_1_cache(self):
+		r = requests.get(URL)
+		assert r.status_code == 200
+		etag = r.headers["ETag"]
+		hits = json.loads(requests.get(URL + "cache").text)["hits"]
+
+		#unchanged, so the client can skip the body
+		r = requests.get(URL)
+		assert r.headers["ETag"] == etag
+		r = requests.get(URL, headers={"If-None-Match": etag})
+		assert r.status_code == 304
+		assert r.text == ""
+		if not os.getenv('PHONE_BOOK_MODE') in ("prefork", "reuseport"): #each process counts its own
+			assert json.loads(requests.get(URL + "cache").text)["hits"] >= hits + 2
+
+		#a write gives a new listing
+		text = json.dumps({"surname": "Shepard", "firstname": "Alan", "number": "01818118202"})
+		r = requests.post(URL + "create", data=text)
+		assert r.status_code == 201
+		r = requests.get(URL, headers={"If-None-Match": etag})
+		assert r.status_code == 200
+		assert r.headers["ETag"] != etag
+		assert {"surname": "Shepard", "firstname": "Alan", "number": "01818118202", "address": ""} in json.loads(r.text)
+
+		#searches differing only in case share a cache entry
+		r = requests.post(URL + "search", data=json.dumps({"surname": "shepard"}))
+		assert r.status_code == 200
+		misses = json.loads(requests.get(URL + "cache").text)["misses"]
+		r2 = requests.post(URL + "search", data=json.dumps({"surname": "SHEPARD"}))
+		assert r2.text == r.text
+		if not os.getenv('PHONE_BOOK_MODE') in ("prefork", "reuseport"):
+			assert json.loads(requests.get(URL + "cache").text)["misses"] == misses
+
+	def test_1_compression(self):
+		entries = [{"surname": "Volkov", "firstname": "Vladislav", "number": "0181811%04d" % i, "address": "Soyuz 7K-OKS"} for i in range(20)]
+		r = requests.post(URL + "import", data="\n".join(json.dumps(entry) for entry in entries))
+		assert r.status_code == 200
+
+		r = requests.get(URL, headers={"Accept-Encoding": "identity"})
+		assert r.status_code == 200
+		assert not "Content-Encoding" in r.headers
+		assert r.headers["Vary"] == "Accept-Encoding"
+		listing = json.loads(r.text)
+		etag = r.headers["ETag"]
+
+		#requests decodes it again
+		r = requests.get(URL, headers={"Accept-Encoding": "gzip"})
+		assert r.headers["Content-Encoding"] == "gzip"
+		assert r.headers["ETag"] != etag
+		assert json.loads(r.text) == listing
+		r = requests.get(URL, headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]})
+		assert r.status_code == 304
+		r = requests.get(URL, headers={"Accept-Encoding": "gzip;q=0, deflate"})
+		assert not "Content-Encoding" in r.headers
+
+		r = requests.get(URL, params={"stream": "1"}, headers={"Accept-Encoding": "gzip"})
+		assert r.headers["Content-Encoding"] == "gzip"
+		assert json.loads(r.text) == listing
+
+		#too small to bother
+		r = requests.get(URL + "cache", headers={"Accept-Encoding": "gzip"})
+		assert not "Content-Encoding" in r.headers
+
+	def test_1_unicode(self):
+		#lengths are counted in bytes, not characters
+		entry = {"surname": "Kononenko", "firstname": "Олег", "number": "01818118203", "address": "Байконур"}
+		r = requests.post(URL + "create", data=json.dumps(entry))
+		assert r.status_code == 201
+		r = requests.post(URL + "search", data=json.dumps({"surname": "Kononenko"}))
+		assert r.status_code == 200
+		assert int(r.headers["Content-Length"]) == len(r.content)
+		assert json.loads(r.text) == [entry]
+
+	def test_1_metrics(self):
+		r = requests.post(URL + "search", data=json.dumps({"surname": "Lovell"}))
+		r = requests.get(URL + "metrics")
+		assert r.status_code == 200
+		assert r.headers["content-type"].startswith("text/plain")
+		assert "# TYPE phonebook_requests_total counter" in r.text
+		if not os.getenv('PHONE_BOOK_MODE') in ("prefork", "reuseport"): #each process counts its own
+			assert 'phonebook_requests_total{action="search",code=' in r.text
+			assert 'phonebook_request_duration_seconds_bucket{action="search",le="+Inf"}' in r.text
+			for stage in ("read", "parse", "write"):
+				assert 'phonebook_stage_duration_seconds_count{action="search",stage="%s"}' % stage in r.text
+
+	def test_1_lookup(self):
+		entry = {"surname": "Tereshkova", "firstname": "Valentina", "number": "+44 1818 118206", "address": "Vostok 6"}
+		r = requests.post(URL + "create", data=json.dumps(entry))
+		assert r.status_code == 201
+
+		#the same number written another way is the same entry
+		r = requests.post(URL + "create", data=json.dumps(dict(entry, number="01818-118206")))
+		assert r.status_code == 409
+		assert r.text == "Duplicate entry."
+
+		r = requests.get(URL + "lookup", params={"number": "0044 (1818) 118206"})
+		assert r.status_code == 200
+		assert json.loads(r.text) == [entry]
+		r = requests.get(URL + "lookup", params={"number": "01818118299"})
+		assert r.status_code == 404
+
+		r = requests.post(URL + "lookup", data=json.dumps(["01818 118206", "01818118299"]))
+		assert r.status_code == 200
+		assert json.loads(r.text) == {"01818 118206": [entry], "01818118299": []}
+		r = requests.post(URL + "lookup", data=json.dumps("01818118206"))
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+		r = requests.get(URL + "lookup")
+		assert r.status_code == 400
+		assert r.text == "Missing compulsory field."
+
+	def test_1_suggest(self):
+		def suggest(expected, **params):
+			#other processes catch up with writes in the background
+			deadline = time.time() + 10
+			while True:
+				r = requests.get(URL + "suggest", params=params)
+				assert r.status_code == 200
+				if json.loads(r.text) == expected or time.time() > deadline:
+					return json.loads(r.text)
+				time.sleep(0.1)
+
+		for (surname, firstname) in (("Quintana", "Quentin"), ("quinn", "Quentin"), ("Quinn", "Ursula")):
+			text = json.dumps({"surname": surname, "firstname": firstname, "number": "01818118205"})
+			r = requests.post(URL + "create", data=text)
+			assert r.status_code == 201
+		expected = {"surnames": ["Quinn", "quinn", "Quintana"], "firstnames": ["Quentin"]}
+		assert suggest(expected, prefix="QU") == expected
+		expected = {"surnames": ["Quinn"], "firstnames": ["Quentin"]}
+		assert suggest(expected, prefix="qu", limit=1) == expected
+
+		#names go once no entry has them any more
+		r = requests.post(URL + "remove", data=json.dumps({"surname": "quinn", "firstname": "Quentin", "number": "01818118205", "address": ""}))
+		assert r.status_code == 201
+		r = requests.post(URL + "update", data=json.dumps({"surname": "Quintana", "firstname": "Quentin", "number": "01818118205", "address": "",
+			"newsurname": "Quist", "newfirstname": "Quentin", "newnumber": "01818118205", "newaddress": ""}))
+		assert r.status_code == 201
+		expected = {"surnames": ["Quinn", "Quist"], "firstnames": ["Quentin"]}
+		assert suggest(expected, prefix="qu") == expected
+
+		r = requests.get(URL + "suggest")
+		assert r.status_code == 400
+		assert r.text == "Missing compulsory field."
+		r = requests.get(URL + "suggest", params={"prefix": "qu", "limit": "lots"})
+		assert r.status_code == 400
+		assert r.text == "Bad request data."
+
+	@unittest.skipUnless(os.getenv('PHONE_BOOK_REPLICA_URL'), "needs a replica of the database running")
+	def test_1_replica(self):
+		replica = os.getenv('PHONE_BOOK_REPLICA_URL')
+		entry = {"surname": "Komarov", "firstname": "Vladimir", "number": "01818118204", "address": ""}
+		r = requests.post(URL + "create", data=json.dumps(entry))
+		assert r.status_code == 201
+
+		#reads catch up once the replica notices the change
+		everything = json.loads(requests.get(URL).text)
+		deadline = time.time() + 10
+		while entry not in json.loads(requests.get(replica).text or "[]"):
+			assert time.time() < deadline
+			time.sleep(0.1)
+		#each process of a prefork or reuseport replica loads its own
+		time.sleep(0.5)
+		assert json.loads(requests.get(replica).text) == everything
+		assert json.loads(requests.get(replica, params={"stream": 1}).text) == everything
+		params = {"limit": 3}
+		for i in range(3):
+			page = json.loads(requests.get(URL, params=params).text)
+			assert json.loads(requests.get(replica, params=params).text) == page
+			params["after"] = page["after"]
+		for term in ("komarov", "K_M%V", "Zarkon"):
+			text = json.dumps({"surname": term})
+			r = requests.post(URL + "search", data=text)
+			r2 = requests.post(replica + "search", data=text)
+			assert r2.status_code == r.status_code
+			assert json.loads(r2.text or "null") == json.loads(r.text or "null")
+
+		r = requests.post(replica + "create", data=json.dumps(entry))
+		assert r.status_code == 403
+		assert r.text == "Read only replica."
+
 	def test_1_bad_url(self):
 		entry = {"surname": "Lovell", "firstname": "Jack"}
 		text = json.dumps(entry)
@@ -276,6 +748,21 @@ class PhoneBookTest(unittest.TestCase):
 		assert r.status_code == 404
 		assert r.text == "Unknown action."
 
+	def test_1_bare_target(self):
+		#a request target without a slash is answered like any other
+		for (request, status) in ((b"GET abc HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n", b"200"),
+				(b"POST x HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\nConnection: close\r\n\r\n{}", b"404")):
+			s = socket.create_connection(("localhost", 8000), timeout=10)
+			s.sendall(request)
+			response = b""
+			while True:
+				chunk = s.recv(65536)
+				if not chunk:
+					break
+				response += chunk
+			s.close()
+			assert response.startswith(b"HTTP/1.1 " + status + b" ")
+
 	def test_1_http_head(self):
 		r = requests.head(URL)
 		assert r.status_code == 200
@@ -284,6 +771,297 @@ class PhoneBookTest(unittest.TestCase):
 		assert 200 <= r.status_code < 300
 		assert r.headers['content-type'] == "application/json"
 
+	def test_1_pipelining(self):
+		#two requests in one write come back as two responses on the same connection
+		body = json.dumps({"surname": "Kelly"}).encode()
+		search = b"POST /search HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+		s = socket.create_connection(("localhost", 8000))
+		s.sendall(search + b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+		response = b""
+		while True:
+			chunk = s.recv(65536)
+			if not chunk:
+				break
+			response += chunk
+		s.close()
+		assert response.startswith(b"HTTP/1.1 404 ")
+		assert response.count(b"HTTP/1.1 ") == 2
+		assert b"HTTP/1.1 200 OK" in response
+
+	def test_1_keep_alive(self):
+		def exchange(s, request):
+			#reads one response with a Content-Length off the connection
+			s.sendall(request)
+			response = b""
+			while not b"\r\n\r\n" in response:
+				response += s.recv(65536)
+			(head, body) = response.split(b"\r\n\r\n", 1)
+			length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+			while len(body) < length:
+				body += s.recv(65536)
+			return(head, body)
+
+		#the connection stays open between requests, even a GET with a body
+		s = socket.create_connection(("localhost", 8000), timeout=10)
+		(head, body) = exchange(s, b"GET /cache HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\n{}")
+		assert head.startswith(b"HTTP/1.1 200 ")
+		(head, body) = exchange(s, b"POST /search HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\n{}")
+		assert head.startswith(b"HTTP/1.1 400 ")
+
+		#the body has to say how long it is, and not be too long
+		(head, body) = exchange(s, b"POST /search HTTP/1.1\r\nHost: localhost\r\n\r\n")
+		assert head.startswith(b"HTTP/1.1 411 ")
+		assert s.recv(65536) == b""
+		s.close()
+		s = socket.create_connection(("localhost", 8000), timeout=10)
+		(head, body) = exchange(s, b"POST /search HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1000000000000\r\n\r\n")
+		assert head.startswith(b"HTTP/1.1 413 ")
+		assert body == b"Request too large."
+		s.close()
+
+		r = requests.get(URL + "metrics")
+		assert "# TYPE phonebook_shed_requests_total counter" in r.text
+
+	@unittest.skipUnless(READ_TIMEOUT <= 5, "needs the server running with a short PHONE_BOOK_READ_TIMEOUT")
+	def test_1_read_timeout(self):
+		def answer(s):
+			response = b""
+			try:
+				while True:
+					chunk = s.recv(65536)
+					if not chunk:
+						break
+					response += chunk
+			except ConnectionError:
+				pass
+			s.close()
+			return response
+
+		#a head trickling in a byte at a time has to arrive within the timeout all the same
+		s = socket.create_connection(("localhost", 8000), timeout=READ_TIMEOUT + 5)
+		start = time.time()
+		try:
+			for byte in b"GET / HTTP/1.1\r\nHost: localhost\r\nX-Slow: " + b"x" * 1000:
+				s.sendall(bytes([byte]))
+				if select.select([s], [], [], 0.25)[0]:
+					break
+		except ConnectionError:
+			pass
+		response = answer(s)
+		assert response.startswith(b"HTTP/1.1 408 ")
+		assert time.time() - start < READ_TIMEOUT + 2
+
+		#as does one which stops part way
+		s = socket.create_connection(("localhost", 8000), timeout=READ_TIMEOUT + 5)
+		s.sendall(b"GET / HTTP/1.1\r\nHost: loc")
+		assert answer(s).startswith(b"HTTP/1.1 408 ")
+
+	def test_1_migrations(self):
+		#importing the server only defines things, it doesn't touch the database
+		import phonebookd
+		for path in phonebookd.shards.files:
+			db = sqlite3.connect(path)
+			deadline = time.time() + 10
+			while db.execute("PRAGMA user_version;").fetchone()[0] < phonebookd.migrations.latest and time.time() < deadline:
+				time.sleep(0.05)
+			assert db.execute("PRAGMA user_version;").fetchone()[0] == phonebookd.migrations.latest
+			assert not db.execute("SELECT 1 FROM sqlite_master WHERE name='phonebook_fts_progress'").fetchone()
+			db.close()
+
+		#once the background migrations are done searches use the indexes they built
+		r = requests.post(URL + "search", data=json.dumps({"surname": {"substring": "Ford"}, "firstname": {"prefix": "F"}, "explain": True}))
+		assert r.status_code == 200
+		plans = json.loads(r.text)
+		for plan in (plans if SHARDS > 1 else [plans]):
+			assert sorted(candidate["index"] for candidate in plan["candidates"]) == ["phonebook_firstname_nocase", "phonebook_fts"]
+
+		#in process, upgrading a database from before versioning moves the entries which
+		#are dupes once their numbers are normalised aside rather than losing them
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, "old.db")
+			db = sqlite3.connect(path)
+			db.execute("CREATE TABLE phonebook (surname TEXT NOT NULL, firstname TEXT NOT NULL, number TEXT NOT NULL, address TEXT NOT NULL)")
+			db.executemany("INSERT INTO phonebook VALUES (?, ?, ?, ?)", [("Dent", "Arthur", "01818118181", ""),
+				("Dent", "Arthur", "+44 1818 118181", ""), ("Dent", "Arthur", "01818-118181", ""), ("Dent", "Arthur", "01818118181", "")])
+			db.commit()
+			out = io.StringIO()
+			with contextlib.redirect_stdout(out):
+				phonebookd.migrations.run(phonebookd.ConnectionPool(path, 1))
+			assert db.execute("SELECT surname, firstname, number, address FROM phonebook").fetchall() == [("Dent", "Arthur", "01818118181", "")]
+			assert db.execute("SELECT number, index_name FROM phonebook_dupes ORDER BY rowid").fetchall() == [("01818118181", "phonebook_entry"),
+				("+44 1818 118181", "phonebook_entry_e164"), ("01818-118181", "phonebook_entry_e164")]
+			assert out.getvalue().count("Moving duplicate entry") == 3
+			assert '"number": "+44 1818 118181"' in out.getvalue()
+
+			#the column keeps the country code it was built with, the server won't start
+			#with another as lookups would miss every national number
+			assert phonebookd.country_code(db) == phonebookd.COUNTRY_CODE
+			phonebookd.check_country_code(db, path)
+			(code, phonebookd.COUNTRY_CODE) = (phonebookd.COUNTRY_CODE, phonebookd.COUNTRY_CODE + "1")
+			try:
+				phonebookd.check_country_code(db, path)
+				assert False, "another country code should stop the server"
+			except SystemExit as e:
+				assert "country code %s, not %s" % (code, code + "1") in str(e)
+			finally:
+				phonebookd.COUNTRY_CODE = code
+			db.close()
+
+	@unittest.skipUnless(SHARDS > 1, "needs the server running with PHONE_BOOK_SHARDS")
+	def test_1_shards(self):
+		import phonebookd
+		owner = phonebookd.shards.owner
+		first = "Popovich"
+		second = [surname for surname in ("Nikolayev", "Bykovsky", "Volynov", "Belyayev") if owner(surname) != owner(first)][0]
+		assert all(os.path.exists(path) for path in phonebookd.shards.files)
+		r = requests.get(URL + "changes")
+		assert r.status_code == 200
+		last = json.loads(r.text)["last"]
+		assert len(last.split(".")) == SHARDS
+
+		entries = [{"surname": first, "firstname": "Vitaly", "number": "01818118230", "address": "Vostok 4"},
+			{"surname": second, "firstname": "Vitaly", "number": "01818118231", "address": ""}]
+		for entry in entries:
+			assert requests.post(URL + "create", data=json.dumps(entry)).status_code == 201
+
+		#listings, pages and searches are merged from every shard in surname order
+		listing = json.loads(requests.get(URL).text)
+		assert all(entry in listing for entry in entries)
+		assert [entry["surname"] for entry in listing] == sorted(entry["surname"] for entry in listing)
+		pages = []
+		page = {"after": ""}
+		while page["after"] is not None:
+			page = json.loads(requests.get(URL, params=dict({"limit": 3}, **({"after": page["after"]} if page["after"] else {}))).text)
+			pages += page["entries"]
+		assert pages == listing
+		ordered = sorted(entries, key=lambda entry: entry["surname"])
+		r = requests.post(URL + "search", data=json.dumps({"firstname": {"exact": "Vitaly"}}))
+		assert json.loads(r.text) == ordered
+		r = requests.post(URL + "search", data=json.dumps({"firstname": {"exact": "Vitaly"}, "limit": 1, "offset": 1}))
+		assert json.loads(r.text) == ordered[1:]
+		r = requests.post(URL + "search", data=json.dumps({"firstname": {"exact": "Vitaly"}, "explain": True}))
+		assert len(json.loads(r.text)) == SHARDS
+
+		#an update to a surname on another shard moves the entry, but not onto a dupe
+		move = dict(entries[0], newsurname=second, newfirstname="Vitaly", newnumber="01818118232", newaddress="")
+		assert requests.post(URL + "update", data=json.dumps(move)).status_code == 201
+		assert requests.post(URL + "update", data=json.dumps(move)).status_code == 404
+		assert requests.post(URL + "create", data=json.dumps(entries[0])).status_code == 201
+		back = {"surname": second, "firstname": "Vitaly", "number": "01818118232", "address": "",
+			"newsurname": first, "newfirstname": "Vitaly", "newnumber": "01818118230", "newaddress": "Vostok 4"}
+		r = requests.post(URL + "update", data=json.dumps(back))
+		assert r.status_code == 409
+		r = requests.post(URL + "search", data=json.dumps({"firstname": {"exact": "Vitaly"}}))
+		assert sorted(entry["number"] for entry in json.loads(r.text)) == ["01818118230", "01818118231", "01818118232"]
+
+		#and in a bulk request the operations after a move see it
+		ops = [{"op": "create", "surname": first, "firstname": "Andriyan", "number": "01818118233"},
+			dict(op="update", surname=first, firstname="Andriyan", number="01818118233", address="",
+				newsurname=second, newfirstname="Andriyan", newnumber="01818118233", newaddress=""),
+			{"op": "remove", "surname": second, "firstname": "Andriyan", "number": "01818118233", "address": ""}]
+		r = requests.post(URL + "bulk", data=json.dumps(ops))
+		assert json.loads(r.text) == [{"status": 201}] * 3
+
+		#each shard numbers its own changes, and a cursor has a number for every shard
+		r = requests.get(URL + "changes", params={"since": last})
+		assert r.status_code == 200
+		found = json.loads(r.text)
+		assert sorted((change["op"], change["surname"], change["number"]) for change in found["changes"]) == sorted([
+			("create", first, "01818118230"), ("create", second, "01818118231"),
+			("create", second, "01818118232"), ("remove", first, "01818118230"), ("create", first, "01818118230"),
+			("create", first, "01818118233"), ("create", second, "01818118233"), ("remove", first, "01818118233"), ("remove", second, "01818118233")])
+		assert all(change["shard"] == owner(change["surname"]) for change in found["changes"])
+		r = requests.get(URL + "changes", params={"since": found["last"]})
+		assert json.loads(r.text) == {"changes": [], "last": found["last"]}
+		r = requests.get(URL + "changes", params={"since": "0"})
+		assert r.status_code == 410
+		r = requests.get(URL + "changes", params={"since": "0.x"})
+		assert r.status_code == 400
+
+	def test_1_profiling(self):
+		#both opt in, and with PHONE_BOOK_PROFILE_SAMPLE=1 every request is profiled
+		r = requests.get(URL + "profile")
+		if not int(os.getenv('PHONE_BOOK_PROFILE_SAMPLE', 0)):
+			assert r.status_code == 404
+			assert r.text == "Profiling is off."
+		else:
+			r = requests.get(URL + "profile", params={"sort": "tottime", "limit": 10})
+			assert r.status_code == 200
+			assert "requests profiled" in r.text and "function calls" in r.text
+			r = requests.get(URL + "profile", params={"format": "pstats"})
+			assert r.status_code == 200
+			assert type(marshal.loads(r.content)) is dict
+			r = requests.get(URL + "profile", params={"sort": "sideways"})
+			assert r.status_code == 400
+		r = requests.get(URL + "slow")
+		if not float(os.getenv('PHONE_BOOK_SLOW_QUERY_MS', 0)):
+			assert r.status_code == 404
+			assert r.text == "Slow query log is off."
+		else:
+			assert r.status_code == 200
+			assert type(json.loads(r.text)["queries"]) is list
+
+		#in process, a scan long enough to be logged is, along with its plan
+		import phonebookd
+		with tempfile.TemporaryDirectory() as tmp:
+			pool = phonebookd.ConnectionPool(os.path.join(tmp, "slow.db"), 1)
+			slow = phonebookd.SlowQueries(0, 10)
+			with pool.reader() as db:
+				slow.watch(pool, db)
+				db.execute("CREATE TABLE t (a TEXT)")
+				db.executemany("INSERT INTO t VALUES (?)", ((str(i),) for i in range(10000)))
+				db.commit()
+				assert db.execute("SELECT count(*) FROM t WHERE a LIKE ?", ("%99%",)).fetchone()[0] == 280
+			queries = [query for query in slow.report()["queries"] if query["sql"].startswith("SELECT count(*)")]
+			assert queries[0]["sql"] == "SELECT count(*) FROM t WHERE a LIKE '%99%'"
+			assert queries[0]["plan"] == ["SCAN t"]
+			assert queries[0]["ms"] >= 0
+			pool.idle.get().close()
+
+	def test_1_group_commit(self):
+		#in process, a write failing in a group commit is rolled back on its own and the
+		#rest of its batch still commits
+		import phonebookd
+		with tempfile.TemporaryDirectory() as tmp:
+			pool = phonebookd.ConnectionPool(os.path.join(tmp, "group.db"), 1)
+			pool.write(lambda db: db.execute("CREATE TABLE t (a TEXT UNIQUE NOT NULL)"))
+			def insert(value):
+				return lambda db: db.execute("INSERT INTO t VALUES (?)", (value,)).rowcount
+			committed = []
+			#queued before the committer starts so they all go in one batch
+			values = ["a", "b", "a", None, "c"]
+			futures = [concurrent.futures.Future() for value in values]
+			for (value, future) in zip(values, futures):
+				pool.pending.put((insert(value), lambda db, result, value=value: committed.append(value), future))
+			assert pool.group_write(insert("d"), None) == 1
+			assert [future.result() for future in futures[:2]] == [1, 1]
+			assert type(futures[2].exception()) is sqlite3.IntegrityError
+			assert type(futures[3].exception()) is sqlite3.IntegrityError
+			assert futures[4].result() == 1
+			assert committed == ["a", "b", "c"]
+			with pool.reader() as db:
+				assert db.execute("SELECT a FROM t ORDER BY a").fetchall() == [("a",), ("b",), ("c",), ("d",)]
+			pool.idle.get().close()
+			pool.writer.close()
+			#a batch failing outside its writes, here in connecting, fails that batch and
+			#the committer carries on with the next one
+			pool = phonebookd.ConnectionPool(os.path.join(tmp, "group.db"), 1)
+			connect = pool.connect
+			def refuse():
+				pool.connect = connect
+				raise sqlite3.OperationalError("unable to open database file")
+			pool.connect = refuse
+			try:
+				pool.group_write(insert("e"), None)
+				assert False, "the failed batch should raise"
+			except sqlite3.OperationalError:
+				pass
+			assert pool.group_write(insert("f"), None) == 1
+			with pool.reader() as db:
+				assert db.execute("SELECT a FROM t WHERE a > 'd' ORDER BY a").fetchall() == [("f",)]
+			pool.idle.get().close()
+			pool.writer.close()
+
 	'''def test_1_non_utf_8(self):
 		# "þÿ" (fe ff) is not valid in any utf-8 string
 		entry = {"surname": "kosþÿme", "firstname": "κόσμε", "number": "01818118193", "address": ""}
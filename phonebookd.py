@@ -1,21 +1,1767 @@
 import http.server, socketserver
-import os, traceback
+import os, signal, socket, traceback
 import sqlite3, json
+import contextlib, queue, threading
+import asyncio, concurrent.futures
+import urllib.parse, email.message
+import collections, hashlib, heapq, itertools
+import array, bisect, operator, re, select, sys, time
+import argparse, csv, io, zlib
+import cProfile, marshal, pstats
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 HOST = ""
-PORT = 8000
-DATABASE = "phonebook.db"
+PORT = int(os.getenv('PHONE_BOOK_PORT', 8000))
+DATABASE = os.getenv('PHONE_BOOK_DATABASE', "phonebook.db")
+#"single" serves one request at a time, "threaded" uses a pool of WORKERS threads,
+#"prefork" forks WORKERS processes which all accept on the same socket, "reuseport"
+#forks WORKERS processes which each listen on their own SO_REUSEPORT socket and "asyncio"
+#serves every connection from one event loop with WORKERS threads for the database
+MODE = os.getenv('PHONE_BOOK_MODE', "threaded")
+WORKERS = int(os.getenv('PHONE_BOOK_WORKERS', 8))
+#seconds an idle keep-alive connection is held open
+KEEPALIVE_TIMEOUT = float(os.getenv('PHONE_BOOK_KEEPALIVE_TIMEOUT', 60))
+#seconds a request's head, or its whole body, has to arrive in
+READ_TIMEOUT = float(os.getenv('PHONE_BOOK_READ_TIMEOUT', 30))
+#largest request line and headers accepted, in bytes
+MAX_HEAD = 65536
+#largest request body accepted, in bytes
+MAX_BODY = int(os.getenv('PHONE_BOOK_MAX_BODY', 64 * 1024 * 1024))
+#most connections or requests left waiting for a worker before more are turned away
+MAX_QUEUE = int(os.getenv('PHONE_BOOK_MAX_QUEUE', 128))
+#seconds clients turned away are asked to wait
+RETRY_AFTER = 1
+#most reader connections each process will hold open, the writer is extra
+POOL_SIZE = int(os.getenv('PHONE_BOOK_POOL_SIZE', 8))
+#database files the entries are split across by surname, each with its own pool and
+#writer, 1 keeps them all in DATABASE
+SHARDS = int(os.getenv('PHONE_BOOK_SHARDS', 1))
+#most entries in one page of a paged listing
+MAX_PAGE = int(os.getenv('PHONE_BOOK_MAX_PAGE', 10000))
+#stream every unpaged listing rather than only those asking with ?stream=1
+STREAM = bool(os.getenv('PHONE_BOOK_STREAM'))
+#rows fetched from the cursor per chunk of a streamed listing
+STREAM_BATCH = 1000
+#most operations from a bulk request applied in one transaction
+BULK_BATCH = int(os.getenv('PHONE_BOOK_BULK_BATCH', 10000))
+#"strict" fsyncs every commit, "wal" only fsyncs at checkpoints so the latest commits
+#can be lost on power failure and "group" fsyncs every commit but batches writes from
+#many requests into each commit
+DURABILITY = os.getenv('PHONE_BOOK_DURABILITY', "strict")
+#a group commit waits at most this long, or for this many writes, before committing
+GROUP_COMMIT_MS = float(os.getenv('PHONE_BOOK_GROUP_COMMIT_MS', 5))
+GROUP_COMMIT_WRITES = int(os.getenv('PHONE_BOOK_GROUP_COMMIT_WRITES', 1000))
+#bytes of encoded listing and search responses kept in memory, 0 turns the cache off
+CACHE_SIZE = int(os.getenv('PHONE_BOOK_CACHE_SIZE', 64 * 1024 * 1024))
+#"orjson" if it is installed, otherwise "stdlib"
+JSON = os.getenv('PHONE_BOOK_JSON', "orjson" if orjson else "stdlib")
+#log one in every LOG_SAMPLE requests, 0 logs none of them
+LOG_SAMPLE = int(os.getenv('PHONE_BOOK_LOG_SAMPLE', 1))
+#profile one in every PROFILE_SAMPLE requests with cProfile for /profile, 0 profiles none
+PROFILE_SAMPLE = int(os.getenv('PHONE_BOOK_PROFILE_SAMPLE', 0))
+#log SQL statements running for this many milliseconds or more for /slow, 0 logs none
+SLOW_QUERY_MS = float(os.getenv('PHONE_BOOK_SLOW_QUERY_MS', 0))
+#virtual machine instructions between checks on how long a statement has been running
+SLOW_QUERY_STEPS = 1000
+#slow statements kept, the oldest go first
+MAX_SLOW = 100
+#"fts" searches through a trigram index, "like" scans the whole table
+SEARCH = os.getenv('PHONE_BOOK_SEARCH', "fts")
+#serve listings and searches from an in-memory snapshot of a database some other
+#phonebookd writes to, and turn writes away
+REPLICA = bool(os.getenv('PHONE_BOOK_REPLICA'))
+#seconds between a replica's checks on whether the database has changed
+REPLICA_POLL = float(os.getenv('PHONE_BOOK_REPLICA_POLL', 1))
+#most suggestions given for each of surname and firstname
+MAX_SUGGEST = 100
+#the search planner counts at most this many rows to size up each index
+PLAN_SAMPLE = 1000
+#the country code for national numbers, those starting with a single 0, this is built
+#into the normalised number column when it is created and the server won't start
+#with another
+COUNTRY_CODE = os.getenv('PHONE_BOOK_COUNTRY_CODE', "44")
+#most numbers in one batch lookup
+MAX_LOOKUP = 10000
+
+#content encodings offered in order of preference, br needs the brotli package
+COMPRESS = [encoding for encoding in os.getenv('PHONE_BOOK_COMPRESS', "br,gzip").split(",") if encoding == "gzip" or (encoding == "br" and brotli)]
+#responses smaller than this many bytes go uncompressed, streams are always compressed
+COMPRESS_MIN = int(os.getenv('PHONE_BOOK_COMPRESS_MIN', 1024))
+#middling levels, the best ones cost far more cpu for a few percent
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+#how many rejected entries an import lists by number
+MAX_IMPORT_ERRORS = 100
+#rows a background migration backfills per transaction, writes wait on each one
+MIGRATION_BATCH = 10000
+
+#changes kept for /changes, the oldest are trimmed as new ones are written
+CHANGES_KEEP = int(os.getenv('PHONE_BOOK_CHANGES_KEEP', 100000))
+#longest a /changes request waits or streams, in seconds
+MAX_WAIT = 60
+#how often waiting requests look for changes written by other processes
+CHANGES_POLL = 0.25
+#most /changes requests each process lets wait at once, in every mode but asyncio each
+#one holds a worker while it waits, so always fewer than WORKERS
+MAX_WAITERS = min(int(os.getenv('PHONE_BOOK_MAX_WAITERS', WORKERS // 2)), WORKERS - 1)
+#seconds between comments keeping a quiet event stream open
+HEARTBEAT = 15
+
+#pragmas for each durability profile, strict stays clear of mmap so an I/O error
+#is an exception rather than a SIGBUS
+PROFILES = {
+	"strict": {"synchronous": "FULL", "cache_size": -16384, "mmap_size": 0},
+	"wal": {"synchronous": "NORMAL", "cache_size": -65536, "mmap_size": 268435456},
+	"group": {"synchronous": "FULL", "cache_size": -65536, "mmap_size": 268435456},
+}
+
+ROW_JSON = '{"surname": %s, "firstname": %s, "number": %s, "address": %s}'
+quote = json.encoder.encode_basestring_ascii
+
+def json_row(cursor, row):
+	#a row factory going straight from a row to its json object
+	return ROW_JSON % (quote(row[0]), quote(row[1]), quote(row[2]), quote(row[3]))
+
+def encode(obj):
+	with metrics.stage("serialize"):
+		if JSON == "orjson":
+			return orjson.dumps(obj)
+		return bytes(json.dumps(obj), "utf-8")
+
+def decode(data):
+	with metrics.stage("parse"):
+		if JSON == "orjson":
+			return orjson.loads(data)
+		return json.loads(data)
+
+def encode_rows(rows):
+	#(surname, firstname, number, address) rows to a json array in utf-8, orjson is
+	#quickest given dicts and the standard library given a format string per row
+	with metrics.stage("serialize"):
+		if JSON == "orjson":
+			return orjson.dumps([{"surname": row[0], "firstname": row[1], "number": row[2], "address": row[3]} for row in rows])
+		return bytes("[" + ", ".join(map(json_row, itertools.repeat(None), rows)) + "]", "utf-8")
+
+def compress(data, encoding):
+	with metrics.stage("compress"):
+		if encoding == "br":
+			return brotli.compress(data, quality=BROTLI_QUALITY)
+		c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+		return c.compress(data) + c.flush()
+
+def compress_stream(chunks, encoding):
+	#flushed after every chunk so nothing is held back from the client
+	if encoding == "br":
+		c = brotli.Compressor(quality=BROTLI_QUALITY)
+		(process, finish) = (lambda chunk: c.process(chunk) + c.flush(), c.finish)
+	else:
+		c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+		(process, finish) = (lambda chunk: c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH), c.flush)
+	try:
+		for chunk in chunks:
+			with metrics.stage("compress"):
+				chunk = process(chunk)
+			yield chunk
+		yield finish()
+	finally:
+		chunks.close()
+
+def query_rows(db, sql, params=()):
+	#encodes the (surname, firstname, number, address) rows of a query as they come
+	#off the cursor, so with the standard library the formatting is timed as sql
+	if JSON == "orjson":
+		with metrics.stage("sql"):
+			rows = db.execute(sql, params).fetchall()
+		return encode_rows(rows)
+	with metrics.stage("sql"):
+		c = db.cursor()
+		c.row_factory = json_row
+		c.execute(sql, params)
+		rows = c.fetchall()
+	with metrics.stage("serialize"):
+		return bytes("[" + ", ".join(rows) + "]", "utf-8")
+
+def e164(operand):
+	#sql normalising a number to E.164 by dropping spaces, dashes, dots and brackets and
+	#turning 00 or a national 0 into a +country code, anything which still isn't a number
+	#is left as it was
+	digits = "replace(replace(replace(replace(replace(%s, ' ', ''), '-', ''), '.', ''), '(', ''), ')', '')" % operand
+	return ("CASE WHEN {d} GLOB '*[^0-9+]*' OR substr({d}, 2) GLOB '*[^0-9]*' THEN {n} "
+		"WHEN {d} GLOB '+[1-9]*' THEN {d} "
+		"WHEN {d} GLOB '00[1-9]*' THEN '+' || substr({d}, 3) "
+		"WHEN {d} GLOB '0[1-9]*' THEN '+{cc}' || substr({d}, 2) "
+		"ELSE {n} END").format(d=digits, n=operand, cc=COUNTRY_CODE)
+
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+#an external content index over the table, kept in step by triggers. While it is being
+#filled the triggers only keep up with the rows filled so far.
+FTS_TABLE = '''CREATE VIRTUAL TABLE phonebook_fts USING fts5(surname, firstname, number,
+	content='phonebook', content_rowid='rowid', tokenize='trigram')'''
+FTS_FILLING = "WHEN {row}.rowid <= (SELECT filled FROM phonebook_fts_progress) "
+FTS_TRIGGERS = [("new", '''CREATE TRIGGER phonebook_fts_insert AFTER INSERT ON phonebook {when}BEGIN
+	INSERT INTO phonebook_fts (rowid, surname, firstname, number) VALUES (new.rowid, new.surname, new.firstname, new.number);
+END'''), ("old", '''CREATE TRIGGER phonebook_fts_delete AFTER DELETE ON phonebook {when}BEGIN
+	INSERT INTO phonebook_fts (phonebook_fts, rowid, surname, firstname, number) VALUES ('delete', old.rowid, old.surname, old.firstname, old.number);
+END'''), ("old", '''CREATE TRIGGER phonebook_fts_update AFTER UPDATE ON phonebook {when}BEGIN
+	INSERT INTO phonebook_fts (phonebook_fts, rowid, surname, firstname, number) VALUES ('delete', old.rowid, old.surname, old.firstname, old.number);
+	INSERT INTO phonebook_fts (rowid, surname, firstname, number) VALUES (new.rowid, new.surname, new.firstname, new.number);
+END''')]
+
+#every write to the table, numbered, in the same transaction as the write
+CHANGES_SCHEMA = ['''CREATE TABLE phonebook_changes (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	op TEXT NOT NULL,
+	surname TEXT NOT NULL,
+	firstname TEXT NOT NULL,
+	number TEXT NOT NULL,
+	address TEXT NOT NULL,
+	newsurname TEXT,
+	newfirstname TEXT,
+	newnumber TEXT,
+	newaddress TEXT)''', '''CREATE TRIGGER phonebook_changes_insert AFTER INSERT ON phonebook BEGIN
+	INSERT INTO phonebook_changes (op, surname, firstname, number, address) VALUES ('create', new.surname, new.firstname, new.number, new.address);
+END''', '''CREATE TRIGGER phonebook_changes_delete AFTER DELETE ON phonebook BEGIN
+	INSERT INTO phonebook_changes (op, surname, firstname, number, address) VALUES ('remove', old.surname, old.firstname, old.number, old.address);
+END''', '''CREATE TRIGGER phonebook_changes_update AFTER UPDATE ON phonebook BEGIN
+	INSERT INTO phonebook_changes (op, surname, firstname, number, address, newsurname, newfirstname, newnumber, newaddress)
+		VALUES ('update', old.surname, old.firstname, old.number, old.address, new.surname, new.firstname, new.number, new.address);
+END''']
+
+#entries found to be dupes of an earlier one when a unique index was built, kept aside
+#along with the index which caught them rather than lost
+DUPES_TABLE = '''CREATE TABLE IF NOT EXISTS phonebook_dupes (
+	surname TEXT NOT NULL,
+	firstname TEXT NOT NULL,
+	number TEXT NOT NULL,
+	address TEXT NOT NULL,
+	index_name TEXT NOT NULL)'''
+
+def daemon(target):
+	thread = threading.Thread(target=target, daemon=True)
+	thread.start()
+	return thread
+
+class PerProcess():
+	#threads and executors don't survive a fork, so one of these makes its value the
+	#first time each process asks for it, once however many threads ask at once
+
+	def __init__(self, make):
+		self.make = make
+		self.lock = threading.Lock()
+		self.pid = None
+		self.value = None
+
+	def get(self):
+		if self.pid != os.getpid():
+			with self.lock:
+				if self.pid != os.getpid():
+					self.value = self.make()
+					self.pid = os.getpid()
+		return self.value
+
+class ConnectionPool():
+
+	def __init__(self, database, size):
+		self.database = database
+		self.size = size
+		self.reset()
+
+	def reset(self):
+		#connections must not cross a fork, so each process builds its own
+		self.pid = os.getpid()
+		self.idle = queue.LifoQueue()
+		self.opened = 0
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self.writer = None
+		self.watcher = None
+		self.pending = queue.Queue()
+		self.committer = None
+
+	def connect(self):
+		db = sqlite3.connect(self.database, timeout=30, check_same_thread=False)
+		db.execute("PRAGMA journal_mode=WAL")
+		for (pragma, value) in PROFILES[DURABILITY].items():
+			db.execute("PRAGMA %s=%s" % (pragma, value))
+		if slow.threshold > 0:
+			slow.watch(self, db)
+		return db
+
+	def acquire(self):
+		if self.pid != os.getpid():
+			self.reset()
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			pass
+		with self.lock:
+			if self.opened < self.size:
+				self.opened += 1
+				try:
+					return self.connect()
+				except:
+					self.opened -= 1
+					raise
+		return self.idle.get()
+
+	@contextlib.contextmanager
+	def reader(self):
+		db = self.acquire()
+		try:
+			yield db
+		finally:
+			self.idle.put(db)
+
+	@contextlib.contextmanager
+	def streamer(self):
+		#a connection of its own for a response which goes at the client's pace, rather
+		#than a reader a slow client could keep from everyone else for as long as it likes
+		db = self.connect()
+		try:
+			yield db
+		finally:
+			db.close()
+
+	def data_version(self):
+		#changes whenever any other connection, in any process, commits
+		if self.pid != os.getpid():
+			self.reset()
+		with self.lock:
+			if self.watcher is None:
+				self.watcher = self.connect()
+			return self.watcher.execute("PRAGMA data_version;").fetchone()[0]
+
+	def write(self, func, after=None):
+		#writes are serialised through a single connection and committed as one transaction,
+		#after is called with the writer and the result once committed, before the next write
+		if self.pid != os.getpid():
+			self.reset()
+		if DURABILITY == "group":
+			return self.group_write(func, after)
+		with self.write_lock:
+			if self.writer is None:
+				self.writer = self.connect()
+			try:
+				result = func(self.writer)
+				self.writer.commit()
+			except:
+				self.writer.rollback()
+				raise
+			self.after(after, self.writer, result)
+			return result
+
+	def after(self, after, db, result):
+		#the write is committed by now, so a hook going wrong is logged rather than
+		#failing it, or with group durability taking the rest of the batch and the
+		#committer down with it
+		if not after:
+			return
+		try:
+			after(db, result)
+		except Exception:
+			log.log(traceback.format_exc())
+
+	def writer_version(self):
+		#only changes when a connection other than this process's writer commits,
+		#call with the write lock held
+		if self.writer is None:
+			self.writer = self.connect()
+		return self.writer.execute("PRAGMA data_version;").fetchone()[0]
+
+	def group_write(self, func, after):
+		#returns once the transaction the write went into has been committed
+		future = concurrent.futures.Future()
+		with self.lock:
+			if self.committer is None:
+				self.committer = threading.Thread(target=self.group_commit, daemon=True)
+				self.committer.start()
+		self.pending.put((func, after, future))
+		return future.result()
+
+	def group_commit(self):
+		while True:
+			batch = [self.pending.get()]
+			deadline = time.monotonic() + GROUP_COMMIT_MS / 1000
+			while len(batch) < GROUP_COMMIT_WRITES:
+				try:
+					batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+				except queue.Empty:
+					break
+			try:
+				results = self.commit_batch(batch)
+			except Exception as e:
+				#anything else going wrong, even connecting, fails the batch but not the committer
+				log.log(traceback.format_exc())
+				results = [(future, None, e, None) for (func, after, future) in batch]
+			for (future, result, error, after) in results:
+				if error:
+					future.set_exception(error)
+				else:
+					future.set_result(result)
+
+	def commit_batch(self, batch):
+		#[(future, result, error, after), ...] for a batch of (func, after, future)
+		results = []
+		with self.write_lock:
+			if self.writer is None:
+				self.writer = self.connect()
+			db = self.writer
+			try:
+				db.execute("BEGIN")
+				#a savepoint each so one failing write doesn't take the rest with it
+				for (func, after, future) in batch:
+					db.execute("SAVEPOINT write")
+					try:
+						results.append((future, func(db), None, after))
+						db.execute("RELEASE write")
+					except Exception as e:
+						db.execute("ROLLBACK TO write")
+						db.execute("RELEASE write")
+						results.append((future, None, e, None))
+				db.commit()
+			except Exception as e:
+				if db.in_transaction:
+					db.rollback()
+				results = [(future, None, e, None) for (func, after, future) in batch]
+			for (future, result, error, after) in results:
+				if not error:
+					self.after(after, db, result)
+		return results
+
+class Shards():
+	#the entries split across count database files by a hash of the surname, so every
+	#entry with a surname, and any dupe of it, is in the same one and merging the shards'
+	#listings by surname alone keeps them in order. A single shard is DATABASE itself.
+
+	def __init__(self, database, count, size):
+		self.database = database
+		self.count = count
+		self.size = size
+		self.files = self.layout(database, count)
+		self.pools = [ConnectionPool(path, size) for path in self.files]
+		self.executor = PerProcess(lambda: concurrent.futures.ThreadPoolExecutor(count * size))
+
+	@staticmethod
+	def layout(database, count):
+		if count == 1:
+			return [database]
+		(root, ext) = os.path.splitext(database)
+		return ["%s-%d-of-%d%s" % (root, i, count, ext) for i in range(1, count + 1)]
+
+	def strays(self):
+		#database files from any other number of shards, which rebalancing moves into these
+		(root, ext) = os.path.splitext(self.database)
+		directory = os.path.dirname(self.database)
+		pattern = re.compile(re.escape(os.path.basename(root)) + r"-\d+-of-\d+" + re.escape(ext) + "$")
+		found = [self.database] + [os.path.join(directory, name) for name in sorted(os.listdir(directory or ".")) if pattern.match(name)]
+		return [path for path in found if not path in self.files and os.path.exists(path) and os.path.getsize(path) > 0]
+
+	def owner(self, surname):
+		if self.count == 1:
+			return 0
+		return zlib.crc32(surname.encode("utf-8", "surrogatepass")) % self.count
+
+	def map(self, func, shards=None):
+		#func(shard) for each of the shards, all of them by default, in parallel when there
+		#is more than one. Stages timed on other threads are lost, so the lot is timed as sql.
+		shards = range(self.count) if shards is None else shards
+		if len(shards) == 1:
+			return [func(shards[0])]
+		with metrics.stage("sql"):
+			return list(self.executor.get().map(func, shards))
+
+	@staticmethod
+	def merge(parts, column=0):
+		#one shard's rows as they are, or a k-way merge of every shard's by surname
+		if len(parts) == 1:
+			return iter(parts[0])
+		return heapq.merge(*parts, key=operator.itemgetter(column))
+
+	def data_version(self):
+		return tuple(pool.data_version() for pool in self.pools)
+
+class ResponseCache():
+	#least recently used responses up to a total size in bytes, all of which go
+	#stale when the generation moves on
+
+	def __init__(self, size):
+		self.size = size
+		self.used = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.seen = None
+		self.hits = 0
+		self.misses = 0
+
+	def invalidate(self):
+		with self.lock:
+			self.generation += 1
+
+	def current(self):
+		#writes from other processes only show up in the data version, and
+		#a replica's reads only change when it loads a new snapshot
+		if REPLICA:
+			return(self.generation, replica.current().serial)
+		return(self.generation, shards.data_version())
+
+	def fetch(self, key, compute):
+		#compute gives a (response, data) pair, which comes back with the
+		#data encoded and an ETag for anything successful
+		return self.remember(key, lambda: self.encode(*compute()))
+
+	def remember(self, key, compute):
+		#compute gives a (response, data, headers) response to keep as it is
+		if self.size <= 0:
+			return compute()
+		generation = self.current()
+		with self.lock:
+			if generation != self.seen:
+				self.entries.clear()
+				self.used = 0
+				self.seen = generation
+			entry = self.entries.get(key)
+			if entry:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+			self.misses += 1
+		#stored against the generation from before the read, so a write in the
+		#meantime makes it stale rather than wrong
+		entry = compute()
+		size = len(entry[1])
+		with self.lock:
+			if generation == self.seen and size <= self.size and not key in self.entries:
+				self.entries[key] = entry
+				self.used += size
+				while self.used > self.size:
+					(old, evicted) = self.entries.popitem(last=False)
+					self.used -= len(evicted[1])
+		return entry
+
+	@staticmethod
+	def encode(response, data):
+		if isinstance(data, str):
+			data = bytes(data, "utf-8")
+		headers = {}
+		if response == 200:
+			with metrics.stage("serialize"):
+				headers["ETag"] = '"%s"' % hashlib.blake2b(data, digest_size=12).hexdigest()
+		return(response, data, headers)
+
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.used}
+
+class Snapshot():
+	#the whole table sorted by surname then rowid in a few flat arrays: each distinct
+	#surname with its first row, and for each row its rowid and the ids of its other
+	#columns in one buffer of interned strings, already quoted for json
+
+	ROW = bytes(ROW_JSON, "ascii")
+	serials = itertools.count()
+
+	def __init__(self, batches):
+		#built a column of a batch of rows at a time, which is far quicker than a row at a time
+		self.serial = next(self.serials)
+		self.ids = {}
+		self.chunks = []
+		self.offsets = array.array("Q", [0])
+		names = []
+		self.starts = array.array("I")
+		self.surnames = array.array("I")
+		self.rowids = array.array("q")
+		self.firstnames = array.array("I")
+		self.numbers = array.array("I")
+		self.addresses = array.array("I")
+		for rows in batches:
+			(rowids, surnames, firstnames, numbers, addresses) = zip(*rows)
+			last = names[-1] if names else None
+			changes = [i for (i, surname, previous) in zip(itertools.count(), surnames, (last,) + surnames) if surname != previous]
+			names.extend(surnames[i] for i in changes)
+			self.starts.extend(len(self.rowids) + i for i in changes)
+			self.surnames.extend(self.intern([surnames[i] for i in changes]))
+			self.rowids.extend(rowids)
+			self.firstnames.extend(self.intern(firstnames))
+			self.numbers.extend(self.intern(numbers))
+			self.addresses.extend(self.intern(addresses))
+		self.starts.append(len(self.rowids))
+		self.values = b"".join(self.chunks)
+		del self.ids, self.chunks
+		#searches run over every distinct surname at once, kept apart by nul
+		self.names = "".join(name + "\0" for name in names)
+		self.folded = self.names.translate(ASCII_LOWER)
+		self.name_offsets = array.array("Q", itertools.accumulate((len(name) + 1 for name in names), initial=0))
+
+	def intern(self, column):
+		#ids for a column of strings, adding any new ones to the end of the values
+		seen = len(self.ids)
+		ids = [self.ids.setdefault(value, len(self.ids)) for value in column]
+		if len(self.ids) > seen:
+			#first appearances come in the order their ids were handed out
+			quoted = [bytes(quote(value), "ascii") for value in dict.fromkeys(value for (value, i) in zip(column, ids) if i >= seen)]
+			self.chunks.append(b"".join(quoted))
+			end = self.offsets[-1]
+			self.offsets.extend(end + length for length in itertools.accumulate(map(len, quoted)))
+		return ids
+
+	@classmethod
+	def load(cls, db):
+		c = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='phonebook'")
+		if not c.fetchone():
+			return cls(())
+		c = db.execute("SELECT rowid, surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;")
+		return cls(iter(lambda: c.fetchmany(STREAM_BATCH * 10), []))
+
+	def __len__(self):
+		return len(self.rowids)
+
+	def size(self):
+		columns = (self.offsets, self.starts, self.surnames, self.rowids, self.firstnames, self.numbers, self.addresses, self.name_offsets)
+		return sum(len(a) * a.itemsize for a in columns) + len(self.values) + len(self.names) + len(self.folded)
+
+	def value(self, i):
+		return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+	def name(self, group):
+		return self.names[self.name_offsets[group]:self.name_offsets[group + 1] - 1]
+
+	def group(self, row):
+		return bisect.bisect_right(self.starts, row) - 1
+
+	def rows(self, start, stop):
+		#yields the encoded rows from start up to stop
+		value = self.value
+		group = self.group(start)
+		while start < stop:
+			end = min(stop, self.starts[group + 1])
+			surname = value(self.surnames[group])
+			for i in range(start, end):
+				yield self.ROW % (surname, value(self.firstnames[i]), value(self.numbers[i]), value(self.addresses[i]))
+			start = end
+			group += 1
+
+	def listing(self, start=0, stop=None):
+		stop = len(self) if stop is None else min(stop, len(self))
+		with metrics.stage("serialize"):
+			return b"[" + b", ".join(self.rows(start, stop)) + b"]"
+
+	def stream(self):
+		for start in range(0, len(self), STREAM_BATCH):
+			yield (b"[" if start == 0 else b", ") + self.listing(start, start + STREAM_BATCH)[1:-1]
+		if len(self):
+			yield b"]"
+
+	def page(self, after, limit):
+		#the rows after (surname, rowid) or from the start, and where the next page starts
+		start = 0
+		if after:
+			group = bisect.bisect_left(range(len(self.surnames)), after[0], key=self.name)
+			if group < len(self.surnames) and self.name(group) == after[0]:
+				start = bisect.bisect_right(self.rowids, after[1], self.starts[group], self.starts[group + 1])
+			else:
+				start = self.starts[group]
+		stop = min(len(self), start + limit)
+		after = None
+		if stop - start == limit:
+			after = "%s,%d" % (self.name(self.group(stop - 1)), self.rowids[stop - 1])
+		return(self.listing(start, stop), after)
+
+	@staticmethod
+	def pattern(surname):
+		#the same match as LIKE '%surname%', which folds ASCII case only and
+		#treats % and _ in the term as wildcards
+		parts = []
+		for char in surname.translate(ASCII_LOWER):
+			if char == "%":
+				parts.append("[^\0]*")
+			elif char == "_":
+				parts.append("[^\0]")
+			else:
+				parts.append(re.escape(char))
+		return re.compile("".join(parts))
+
+	def find(self, surname):
+		#every row of each distinct surname the term is found in
+		pattern = self.pattern(surname)
+		groups = []
+		with metrics.stage("sql"):
+			match = pattern.search(self.folded)
+			while match:
+				group = bisect.bisect_right(self.name_offsets, match.start()) - 1
+				groups.append(group)
+				match = pattern.search(self.folded, self.name_offsets[group + 1])
+		return b"[" + b", ".join(self.listing(self.starts[group], self.starts[group + 1])[1:-1] for group in groups) + b"]"
+
+class Replica():
+	#holds the current snapshot and swaps in a new one whenever the database
+	#changes or on SIGHUP, forked workers each watch and load their own
+
+	def __init__(self, database, interval):
+		self.database = database
+		self.interval = interval
+		self.snapshot = None
+		self.watcher = PerProcess(lambda: daemon(self.watch))
+		self.wake = threading.Event()
+		self.forced = False
+		self.db = None
+		self.file = None
+		self.seen = None
+		self.loads = 0
+
+	def connect(self):
+		#read only, and mapped into memory rather than copied through the page cache
+		db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(self.database), uri=True, check_same_thread=False)
+		db.execute("PRAGMA mmap_size=1073741824")
+		return db
+
+	def stamp(self):
+		#the data version only covers this connection's file, if the file has
+		#been replaced the connection has to follow it
+		st = os.stat(self.database)
+		if self.db is None or (st.st_dev, st.st_ino) != self.file:
+			if self.db is not None:
+				self.db.close()
+			self.db = self.connect()
+			self.file = (st.st_dev, st.st_ino)
+		return(self.file, self.db.execute("PRAGMA data_version;").fetchone()[0])
+
+	def start(self):
+		self.seen = self.stamp()
+		self.load()
+		self.current()
+
+	def load(self):
+		start = time.perf_counter()
+		db = self.connect()
+		try:
+			snapshot = Snapshot.load(db)
+		finally:
+			db.close()
+		self.snapshot = snapshot
+		self.loads += 1
+		log.log("Loaded %d entries, %d bytes, in %.3fs\n" % (len(snapshot), snapshot.size(), time.perf_counter() - start))
+
+	def current(self):
+		self.watcher.get()
+		return self.snapshot
+
+	def hangup(self, signum, frame):
+		self.forced = True
+		self.wake.set()
+
+	def watch(self):
+		while True:
+			self.wake.wait(self.interval)
+			self.wake.clear()
+			(forced, self.forced) = (self.forced, False)
+			try:
+				stamp = self.stamp()
+				if forced or stamp != self.seen:
+					self.seen = stamp
+					self.load()
+			except Exception:
+				log.log(traceback.format_exc())
+
+class Suggestions():
+	#every distinct surname and firstname, ASCII case folded and kept sorted for
+	#prefix lookups. This process's own writes are applied as they commit, anything
+	#else changing the database shows up in the writer's data version and has the
+	#lists rebuilt in the background while the old ones carry on answering. There is one
+	#for each shard.
+
+	FIELDS = ("surname", "firstname")
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.lock = threading.Lock()
+		self.keys = dict((field, []) for field in self.FIELDS)
+		self.counts = dict((field, collections.Counter()) for field in self.FIELDS)
+		self.version = None
+		self.seen = None
+		self.pending = None
+		self.watcher = PerProcess(lambda: daemon(self.watch))
+		self.wake = threading.Event()
+
+	@staticmethod
+	def key(name):
+		#sorts by the folded name, with the name itself after a nul
+		return name.translate(ASCII_LOWER) + "\0" + name
+
+	def lookup(self, prefix, limit):
+		prefix = prefix.translate(ASCII_LOWER)
+		found = {}
+		with self.lock:
+			for field in self.FIELDS:
+				keys = self.keys[field]
+				i = bisect.bisect_left(keys, prefix)
+				names = []
+				while i < len(keys) and len(names) < limit and keys[i].startswith(prefix):
+					names.append(keys[i].split("\0", 1)[1])
+					i += 1
+				found[field + "s"] = names
+		return found
+
+	@classmethod
+	def combine(cls, parts, limit):
+		#the first limit names of lookups on each shard, surnames are only ever on one
+		#but a firstname can be on any of them
+		found = {}
+		for field in parts[0]:
+			names = []
+			for name in heapq.merge(*(part[field] for part in parts), key=cls.key):
+				if len(names) == limit:
+					break
+				if not names or names[-1] != name:
+					names.append(name)
+			found[field] = names
+		return found
+
+	@classmethod
+	def build(cls, rows):
+		#sorted keys and counts for each field from (surname, firstname) rows
+		counts = dict((field, collections.Counter()) for field in cls.FIELDS)
+		for (surname, firstname) in rows:
+			counts["surname"][surname] += 1
+			counts["firstname"][firstname] += 1
+		keys = dict((field, sorted(map(cls.key, counts[field]))) for field in cls.FIELDS)
+		return(keys, counts)
+
+	@classmethod
+	def apply(cls, keys, counts, removed, added):
+		for pair in removed:
+			for (field, name) in zip(cls.FIELDS, pair):
+				counts[field][name] -= 1
+				if counts[field][name] <= 0:
+					del counts[field][name]
+					key = cls.key(name)
+					i = bisect.bisect_left(keys[field], key)
+					if i < len(keys[field]) and keys[field][i] == key:
+						del keys[field][i]
+		for pair in added:
+			for (field, name) in zip(cls.FIELDS, pair):
+				counts[field][name] += 1
+				if counts[field][name] == 1:
+					bisect.insort(keys[field], cls.key(name))
+
+	def change(self, db, removed, added, rebuild=False):
+		#called by the writer with the write lock held, as soon as a write has committed,
+		#rebuild when it changed more than removed and added say
+		version = db.execute("PRAGMA data_version;").fetchone()[0]
+		with self.lock:
+			if rebuild:
+				self.version = None
+			if version != self.version:
+				self.wake.set()
+			self.apply(self.keys, self.counts, removed, added)
+			if self.pending is not None:
+				self.pending.append((removed, added, rebuild))
+
+	def start(self):
+		self.refresh()
+		self.check()
+
+	def check(self):
+		#wakes the rebuilder if anything at all has changed since last time
+		self.watcher.get()
+		version = replica.current().serial if REPLICA else self.pool.data_version()
+		if version != self.seen:
+			self.seen = version
+			self.wake.set()
+
+	def watch(self):
+		while True:
+			self.wake.wait()
+			self.wake.clear()
+			try:
+				self.refresh()
+			except Exception:
+				log.log(traceback.format_exc())
+
+	def refresh(self):
+		#rebuilds from a read which starts with the write lock held, so this process's
+		#writes are either in it or replayed on top of it afterwards
+		sql = "SELECT surname, firstname FROM phonebook;"
+		if REPLICA:
+			version = replica.current().serial
+			if version == self.version:
+				return
+			db = replica.connect()
+			try:
+				(keys, counts) = self.build(db.execute(sql))
+			finally:
+				db.close()
+		else:
+			with self.pool.reader() as db:
+				with self.pool.write_lock:
+					version = self.pool.writer_version()
+					if version == self.version:
+						return
+					c = db.execute(sql)
+					rows = c.fetchmany(STREAM_BATCH)
+					with self.lock:
+						self.pending = []
+				(keys, counts) = self.build(itertools.chain(rows, c))
+		with self.lock:
+			for (removed, added, rebuild) in self.pending or ():
+				self.apply(keys, counts, removed, added)
+				if rebuild:
+					version = None
+			self.keys = keys
+			self.counts = counts
+			self.version = version
+			self.pending = None
+
+class ChangeFeed():
+	#reads the change log after a client's cursor, waiting for there to be something if
+	#need be. This process's writes wake waiting requests at once, anyone else's are found
+	#by polling. Each shard numbers its own changes, so a cursor is the sequence number
+	#reached in each, written as a plain number when there is only one shard. A waiting
+	#request holds a worker in every mode but asyncio, so there are at most limit of them
+	#and they give up as soon as busy says a connection is waiting for a worker.
+
+	def __init__(self, interval, limit):
+		self.interval = interval
+		self.limit = limit
+		self.condition = threading.Condition()
+		self.generation = 0
+		self.waiters = 0
+		self.wakers = set()
+		self.busy = lambda: False
+
+	def notify(self):
+		with self.condition:
+			self.generation += 1
+			self.condition.notify_all()
+			wakers = list(self.wakers)
+		for wake in wakers:
+			wake()
+
+	@contextlib.contextmanager
+	def slot(self):
+		#whether a request may wait, taking up one of the limit until it is done
+		with self.condition:
+			taken = self.waiters < self.limit
+			self.waiters += taken
+		try:
+			yield taken
+		finally:
+			if taken:
+				with self.condition:
+					self.waiters -= 1
+
+	@staticmethod
+	def parse(text):
+		cursor = tuple(int(part) for part in text.split("."))
+		if min(cursor) < 0:
+			raise ValueError(text)
+		return cursor
+
+	@staticmethod
+	def format(cursor):
+		return cursor[0] if len(cursor) == 1 else ".".join(map(str, cursor))
+
+	@contextlib.contextmanager
+	def reader(self, shard):
+		#replicas have no pool, and a waiting request doesn't keep hold of a connection
+		if REPLICA:
+			db = replica.connect()
+			try:
+				yield db
+			finally:
+				db.close()
+		else:
+			with shards.pools[shard].reader() as db:
+				yield db
+
+	def read(self, since, limit):
+		#([change, ...], last) with last the cursor to carry on from, None for the latest,
+		#or None if some changes after since have already been trimmed or it is a cursor
+		#for some other number of shards. Changes from different shards take turns.
+		if since is not None and len(since) != shards.count:
+			return None
+		found = shards.map(lambda shard: self.read_shard(shard, None if since is None else since[shard], limit))
+		if None in found:
+			return None
+		if since is None or shards.count == 1:
+			return([change for (changes, last) in found for change in changes], tuple(last for (changes, last) in found))
+		changes = []
+		last = list(since)
+		for turn in itertools.zip_longest(*(part for (part, seq) in found)):
+			for (shard, change) in enumerate(turn):
+				if change is not None and len(changes) < limit:
+					change["shard"] = shard
+					changes.append(change)
+					last[shard] = change["seq"]
+		return(changes, tuple(last))
+
+	def read_shard(self, shard, since, limit):
+		with self.reader(shard) as db, metrics.stage("sql"):
+			#AUTOINCREMENT keeps the last number handed out even once its change is trimmed
+			(first, last) = db.execute("SELECT (SELECT MIN(seq) FROM phonebook_changes), (SELECT seq FROM sqlite_sequence WHERE name='phonebook_changes');").fetchone()
+			last = last or 0
+			if since is None:
+				return([], last)
+			if since > last or (since < last and (first is None or since < first - 1)):
+				return None
+			c = db.execute("SELECT seq, op, surname, firstname, number, address, newsurname, newfirstname, newnumber, newaddress FROM phonebook_changes WHERE seq > ? ORDER BY seq ASC LIMIT ?;",
+				(since, limit))
+			rows = c.fetchall()
+		changes = []
+		for row in rows:
+			change = {"seq": row[0], "op": row[1], "surname": row[2], "firstname": row[3], "number": row[4], "address": row[5]}
+			if row[1] == "update":
+				change.update(newsurname=row[6], newfirstname=row[7], newnumber=row[8], newaddress=row[9])
+			changes.append(change)
+		return(changes, changes[-1]["seq"] if changes else since)
+
+	def wait(self, since, limit, timeout):
+		deadline = time.monotonic() + timeout
+		while True:
+			with self.condition:
+				generation = self.generation
+			found = self.read(since, limit)
+			remaining = deadline - time.monotonic()
+			if found is None or found[0] or remaining <= 0 or self.busy():
+				return found
+			since = found[1]
+			with self.condition:
+				if generation == self.generation:
+					self.condition.wait(min(self.interval, remaining))
+
+	async def wait_async(self, since, limit, timeout, read):
+		#wait on an event loop, with read(since, limit) running read somewhere it can block
+		loop = asyncio.get_running_loop()
+		changed = asyncio.Event()
+		wake = lambda: loop.call_soon_threadsafe(changed.set)
+		with self.condition:
+			self.wakers.add(wake)
+		try:
+			deadline = time.monotonic() + timeout
+			while True:
+				changed.clear()
+				found = await read(since, limit)
+				remaining = deadline - time.monotonic()
+				if found is None or found[0] or remaining <= 0:
+					return found
+				since = found[1]
+				try:
+					await asyncio.wait_for(changed.wait(), min(self.interval, remaining))
+				except asyncio.TimeoutError:
+					pass
+		finally:
+			with self.condition:
+				self.wakers.discard(wake)
+
+	def events(self, since, timeout):
+		#server sent events with the cursor just past each change as its id, so a client
+		#reconnecting with Last-Event-ID carries on where it left off. With limit already
+		#waiting, or once the server is busy, the stream ends and the client reconnects.
+		deadline = time.monotonic() + timeout
+		yield b"retry: 1000\n\n"
+		with self.slot() as waiting:
+			while waiting and not self.busy():
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				found = self.wait(since, STREAM_BATCH, min(HEARTBEAT, remaining))
+				if found is None:
+					yield self.GONE
+					break
+				yield self.batch(since, found[0])
+				since = found[1]
+
+	async def events_async(self, since, timeout, read):
+		deadline = time.monotonic() + timeout
+		yield b"retry: 1000\n\n"
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			found = await self.wait_async(since, STREAM_BATCH, min(HEARTBEAT, remaining), read)
+			if found is None:
+				yield self.GONE
+				break
+			yield self.batch(since, found[0])
+			since = found[1]
+
+	GONE = b"event: gone\ndata: Changes no longer available.\n\n"
+
+	def batch(self, since, changes):
+		#the events for changes after since, or a comment to keep a quiet stream open
+		if not changes:
+			return b":\n\n"
+		cursor = list(since)
+		events = []
+		for change in changes:
+			cursor[change.get("shard", 0)] = change["seq"]
+			events.append(b"id: %s\nevent: change\ndata: %s\n\n" % (bytes(str(self.format(cursor)), "ascii"), encode(change)))
+		return b"".join(events)
+
+class Metrics():
+	#request counts and latency histograms for the prometheus text format, requests
+	#are also timed by stage: reading the body, parsing json, running sql, serializing
+	#and writing the response
+
+	BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.requests = collections.Counter()
+		self.shed_requests = collections.Counter()
+		self.histograms = {}
+
+	def begin(self, action):
+		self.local.stages = collections.Counter()
+		self.local.action = action
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			stages = getattr(self.local, "stages", None)
+			if stages is not None:
+				stages[name] += time.perf_counter() - start
+
+	def end(self, action):
+		stages = self.local.stages
+		self.local.stages = None
+		self.local.action = None
+		for (name, seconds) in stages.items():
+			self.observe("phonebook_stage_duration_seconds", (("action", action), ("stage", name)), seconds)
+
+	def observe(self, metric, labels, seconds):
+		key = (metric, labels)
+		i = bisect.bisect_left(self.BUCKETS, seconds)
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+			histogram[i] += 1
+			histogram[-1] += seconds
+
+	def shed(self, reason):
+		with self.lock:
+			self.shed_requests[reason] += 1
+
+	def request(self, action, response, seconds):
+		with self.lock:
+			self.requests[(action, response)] += 1
+		self.observe("phonebook_request_duration_seconds", (("action", action),), seconds)
+
+	def render(self):
+		lines = ["# TYPE phonebook_requests_total counter"]
+		with self.lock:
+			for ((action, response), count) in sorted(self.requests.items()):
+				lines.append('phonebook_requests_total{action="%s",code="%d"} %d' % (action, response, count))
+			lines.append("# TYPE phonebook_shed_requests_total counter")
+			for (reason, count) in sorted(self.shed_requests.items()):
+				lines.append('phonebook_shed_requests_total{reason="%s"} %d' % (reason, count))
+			histograms = sorted((key, list(value)) for (key, value) in self.histograms.items())
+		last = None
+		for ((metric, labels), histogram) in histograms:
+			if metric != last:
+				lines.append("# TYPE %s histogram" % metric)
+				last = metric
+			labels = ",".join('%s="%s"' % label for label in labels)
+			total = 0
+			for (le, count) in zip(self.BUCKETS + ("+Inf",), histogram):
+				total += count
+				lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, le, total))
+			lines.append("%s_sum{%s} %f" % (metric, labels, histogram[-1]))
+			lines.append("%s_count{%s} %d" % (metric, labels, total))
+		stats = cache.stats()
+		lines.append("# TYPE phonebook_cache_hits_total counter")
+		lines.append("phonebook_cache_hits_total %d" % stats["hits"])
+		lines.append("# TYPE phonebook_cache_misses_total counter")
+		lines.append("phonebook_cache_misses_total %d" % stats["misses"])
+		if REPLICA:
+			lines.append("# TYPE phonebook_replica_entries gauge")
+			lines.append("phonebook_replica_entries %d" % len(replica.current()))
+			lines.append("# TYPE phonebook_replica_loads_total counter")
+			lines.append("phonebook_replica_loads_total %d" % replica.loads)
+		return "\n".join(lines) + "\n"
+
+class RequestLog():
+	#request lines are sampled and handed to a background thread which writes them
+	#out in batches, rather than each request writing to stderr itself
+
+	def __init__(self, sample):
+		self.sample = sample
+		self.count = itertools.count()
+		self.writer = PerProcess(lambda: daemon(self.write))
+		self.lines = queue.SimpleQueue()
+
+	def request(self, line):
+		if self.sample <= 0 or next(self.count) % self.sample:
+			return
+		self.log(line)
+
+	def log(self, line):
+		self.writer.get()
+		self.lines.put(line)
+
+	def write(self):
+		while True:
+			batch = [self.lines.get()]
+			try:
+				while len(batch) < 1000:
+					batch.append(self.lines.get_nowait())
+			except queue.Empty:
+				pass
+			sys.stderr.write("".join(batch))
+			sys.stderr.flush()
+
+class Profiler():
+	#runs one in every sample requests under cProfile and adds their stats up. Only
+	#handling the request is profiled, not reading it or writing the response, nor a
+	#streamed body as that is generated while it is written. Each process has its own.
+
+	SORTS = ("cumulative", "tottime", "calls")
+
+	def __init__(self, sample):
+		self.sample = sample
+		self.count = itertools.count()
+		self.lock = threading.Lock()
+		self.stats = None
+		self.profiled = 0
+
+	def due(self):
+		return next(self.count) % self.sample == 0
+
+	def run(self, func, *args):
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			#newer pythons only allow one profiler at a time, so this one goes without
+			return func(*args)
+		try:
+			return func(*args)
+		finally:
+			profile.disable()
+			with self.lock:
+				if self.stats is None:
+					self.stats = pstats.Stats(profile)
+				else:
+					self.stats.add(profile)
+				self.profiled += 1
+
+	def render(self, sort, limit):
+		#the top limit functions as text, or None if nothing has been profiled yet
+		out = io.StringIO()
+		with self.lock:
+			if self.stats is None:
+				return None
+			out.write("%d requests profiled\n" % self.profiled)
+			self.stats.stream = out
+			self.stats.sort_stats(sort).print_stats(limit)
+		return out.getvalue()
+
+	def dump(self):
+		#the same as pstats.Stats.dump_stats writes, for python3 -m pstats
+		with self.lock:
+			return None if self.stats is None else marshal.dumps(self.stats.stats)
+
+class SlowQueries():
+	#statements which run for threshold seconds or more. A trace callback notes each
+	#statement as it starts on a connection and a progress handler, every SLOW_QUERY_STEPS
+	#instructions of it, how long it has been running. A statement is logged when it
+	#crosses the threshold and its time kept up to date until it is done, so that is
+	#time spent in SQLite's virtual machine to within a check. Plans are looked up when
+	#the log is read. Each process has its own.
+
+	def __init__(self, threshold, keep):
+		self.threshold = threshold
+		self.entries = collections.deque(maxlen=keep)
+		self.lock = threading.Lock()
+		self.logged = 0
+
+	def watch(self, pool, db):
+		#[sql, started, entry] for the statement running on db
+		running = [None, 0, None]
+		def trace(sql):
+			running[:] = [sql, time.perf_counter(), None]
+		def progress():
+			elapsed = time.perf_counter() - running[1]
+			if running[2] is not None:
+				running[2]["ms"] = round(elapsed * 1000, 3)
+			elif running[0] and elapsed >= self.threshold:
+				running[2] = {"sql": running[0], "ms": round(elapsed * 1000, 3), "action": getattr(metrics.local, "action", None),
+					"database": pool.database, "time": round(time.time(), 3), "pool": pool}
+				with self.lock:
+					self.entries.append(running[2])
+					self.logged += 1
+			return 0
+		db.set_trace_callback(trace)
+		db.set_progress_handler(progress, SLOW_QUERY_STEPS)
+
+	def report(self):
+		with self.lock:
+			entries = list(self.entries)
+			logged = self.logged
+		queries = []
+		for entry in entries:
+			if not "plan" in entry:
+				entry["plan"] = self.plan(entry["pool"], entry["sql"])
+			queries.append(dict((key, value) for (key, value) in entry.items() if key != "pool"))
+		return {"threshold_ms": self.threshold * 1000, "logged": logged, "queries": queries}
+
+	@staticmethod
+	def plan(pool, sql):
+		#as the database is now, none for anything which can't be explained
+		try:
+			with pool.reader() as db:
+				return [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql)]
+		except sqlite3.Error:
+			return []
+
+class RequestBody(io.RawIOBase):
+	#an /import body read a piece at a time as its entries are loaded, so it doesn't have
+	#to fit in memory or MAX_BODY. read(size, timeout) is the front end's and gives back at
+	#most size bytes, or none once the client has gone. The client has READ_TIMEOUT in all
+	#to send it, counting only the time spent waiting for it, and left is how much of it
+	#hasn't arrived.
+
+	def __init__(self, read, length):
+		self.read_some = read
+		self.left = length
+		self.waited = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		if self.left <= 0:
+			return 0
+		start = time.monotonic()
+		chunk = self.read_some(min(len(buffer), self.left), max(READ_TIMEOUT - self.waited, 0.001))
+		self.waited += time.monotonic() - start
+		buffer[:len(chunk)] = chunk
+		self.left -= len(chunk)
+		return len(chunk)
+
+class KeepAliveTCPServer(socketserver.TCPServer):
+	#serves a connection at a time, keeping it open between requests until someone
+	#else is waiting to be accepted. The listen backlog is the queue.
+
+	request_queue_size = MAX_QUEUE
+
+	def __init__(self, server_address, RequestHandlerClass):
+		self.idle_lock = threading.Lock()
+		self.idle = collections.OrderedDict()
+		socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass)
+		#requests waiting for changes give way too
+		feed.busy = self.waiting
+
+	def wait_idle(self, connection, timeout):
+		#True when the connection's next request arrives, False when it times out or
+		#is evicted. Evicting shuts it for reading, which wakes the select.
+		if self.waiting():
+			return False
+		with self.idle_lock:
+			self.idle[connection] = True
+		try:
+			ready = select.select([connection] + self.wake_on(), [], [], timeout)[0]
+		finally:
+			with self.idle_lock:
+				evicted = self.idle.pop(connection, None) is None
+		return connection in ready and not evicted
+
+	def waiting(self):
+		return bool(select.select([self.socket], [], [], 0)[0])
+
+	def wake_on(self):
+		return [self.socket]
+
+	def evict(self, count=None):
+		#closes idle connections, oldest first, so their workers are free
+		with self.idle_lock:
+			while self.idle and count != 0:
+				(connection, _) = self.idle.popitem(last=False)
+				count = None if count is None else count - 1
+				try:
+					connection.shutdown(socket.SHUT_RD)
+				except OSError:
+					pass
+
+class ThreadPoolTCPServer(KeepAliveTCPServer):
+	#connections queue for the worker threads, any arriving with MAX_QUEUE already
+	#queued are turned away with a 503, and an idle keep-alive connection gives up
+	#its thread as soon as a connection is queued
+
+	def __init__(self, server_address, RequestHandlerClass, workers):
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		self.workers = workers
+		self.connections = 0
+		KeepAliveTCPServer.__init__(self, server_address, RequestHandlerClass)
+
+	def waiting(self):
+		return self.connections > self.workers
+
+	def wake_on(self):
+		return []
+
+	def process_request(self, request, client_address):
+		with self.idle_lock:
+			if self.connections - self.workers >= MAX_QUEUE:
+				self.shed(request)
+				return
+			self.connections += 1
+		if self.waiting():
+			self.evict(1)
+		self.executor.submit(self.process_request_thread, request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+			with self.idle_lock:
+				self.connections -= 1
+
+	def shed(self, request):
+		#answered from the accepting thread without reading the request, or not at all
+		#should the client not be ready for it
+		metrics.shed("queue")
+		try:
+			request.setblocking(False)
+			request.send(b"HTTP/1.1 503 Service Unavailable\r\nContent-type: application/json\r\nRetry-After: %d\r\n"
+				b"Content-Length: 12\r\nConnection: close\r\n\r\nServer busy." % RETRY_AFTER)
+		except OSError:
+			pass
+		self.shutdown_request(request)
+
+	def server_close(self):
+		socketserver.TCPServer.server_close(self)
+		self.executor.shutdown(wait=True)
+
+class ReusePortTCPServer(KeepAliveTCPServer):
+	#any number of processes can listen on the same port, the kernel spreads
+	#new connections between them
+
+	def server_bind(self):
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		KeepAliveTCPServer.server_bind(self)
+
+class Supervisor():
+	#forks the worker processes and looks after them: a worker which dies is
+	#replaced, SIGHUP starts a fresh set of workers before retiring the old ones
+	#and SIGTERM or SIGINT stops them all, each finishing the request in hand.
+	#Any background work gets a process of its own too, as the supervisor must not
+	#have the database open when it forks.
+
+	def __init__(self, workers, make_server, background=None):
+		self.workers = workers
+		self.make_server = make_server
+		self.background = background
+		self.helper = None
+		self.children = {}
+		self.retiring = set()
+		self.stopping = False
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		signal.signal(signal.SIGHUP, self.restart)
+		for i in range(self.workers):
+			self.spawn()
+		if self.background:
+			self.helper = self.fork(self.assist)
+		while self.children:
+			(pid, status) = os.wait()
+			if pid == self.helper:
+				self.helper = None
+			started = self.children.pop(pid, None)
+			if started is None or pid in self.retiring or self.stopping:
+				self.retiring.discard(pid)
+				continue
+			print("Worker %d exited with status %d, replacing it." % (pid, os.waitstatus_to_exitcode(status)))
+			if time.monotonic() - started < 1:
+				#don't spin if workers die as soon as they start
+				time.sleep(1)
+			if not self.stopping:
+				self.spawn()
+
+	def spawn(self):
+		self.children[self.fork(self.work)] = time.monotonic()
+
+	def fork(self, target):
+		pid = os.fork()
+		if pid == 0:
+			code = 0
+			try:
+				target()
+			except BaseException:
+				traceback.print_exc()
+				code = 1
+			finally:
+				os._exit(code)
+		return pid
+
+	def assist(self):
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+		self.background()
+
+	def work(self):
+		#the supervisor's handlers are no use in a worker, and it passes SIGINT on as SIGTERM
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGHUP, replica.hangup if REPLICA else signal.SIG_IGN)
+		if REPLICA:
+			replica.start()
+		shards.map(lambda shard: suggestions[shard].start())
+		httpd = self.make_server()
+		def stop(signum, frame):
+			#shutdown waits for serve_forever to return, so can't be called from under it
+			httpd.evict()
+			threading.Thread(target=httpd.shutdown).start()
+		signal.signal(signal.SIGTERM, stop)
+		httpd.serve_forever()
+		#connections already queued on a socket of its own are reset when it closes,
+		#and one on a shared socket may have gone to another worker in the meantime
+		httpd.timeout = 0
+		httpd.socket.setblocking(False)
+		while select.select([httpd], [], [], 0)[0]:
+			httpd.handle_request()
+
+	def stop(self, signum, frame):
+		self.stopping = True
+		for pid in self.children:
+			os.kill(pid, signal.SIGTERM)
+		if self.helper:
+			os.kill(self.helper, signal.SIGTERM)
+
+	def restart(self, signum, frame):
+		#the new workers are listening before the old ones stop
+		old = list(self.children)
+		self.retiring.update(old)
+		for i in range(self.workers):
+			self.spawn()
+		for pid in old:
+			os.kill(pid, signal.SIGTERM)
 
 class PhoneBook():
+
+	POST_ACTIONS = ("create", "remove", "update", "search", "bulk", "lookup", "import")
+	GET_ACTIONS = ("cache", "metrics", "suggest", "lookup", "export", "changes", "profile", "slow")
+	EVENT_STREAM = {"Content-type": "text/event-stream", "Cache-Control": "no-cache"}
+
+	@classmethod
+	def action(cls, method, path):
+		#the name requests are counted under
+		#a target without a slash in it is the listing or an unknown action like any other
+		name = (urllib.parse.urlsplit(path).path.split("/") + [""])[1]
+		if method == "POST":
+			return name if name in cls.POST_ACTIONS else "unknown"
+		return name if name in cls.GET_ACTIONS else "list"
+
+	@classmethod
+	def handle(cls, method, path, headers, data):
+		#every front end routes through here with the request headers and raw body,
+		#and gets back the response code, body and any extra headers
+		action = cls.action(method, path)
+		metrics.begin(action)
+		try:
+			if profiler.sample > 0 and profiler.due():
+				return profiler.run(cls.route, method, path, headers, data)
+			return cls.route(method, path, headers, data)
+		finally:
+			metrics.end(action)
+
+	@classmethod
+	def route(cls, method, path, headers, data):
+		try:
+			if method == "POST":
+				result = cls.handle_post(path, data if isinstance(data, RequestBody) else data.decode("utf-8", "strict"))
+			else:
+				result = cls.handle_get(path, headers)
+		except UnicodeDecodeError:
+			return(400, "Bad request data.", {})
+		except TimeoutError:
+			#a streamed body which didn't arrive in time
+			return(408, "Request timeout.", {})
+		except:
+			print(traceback.format_exc())
+			return(500, "Server Error", {})
+		if len(result) == 2:
+			result += ({},)
+		result = cls.compress(headers.get("Accept-Encoding", ""), *result)
+		etag = result[2].get("ETag")
+		match = headers.get("If-None-Match", "")
+		if method == "GET" and etag and (etag in match or match.strip() == "*"):
+			return(304, b"", result[2])
+		return result
 	
+	@staticmethod
+	def encoding(accept):
+		#the encoding the client likes best, the server's preference breaking ties,
+		#or None for no encoding
+		weights = {}
+		for item in accept.split(","):
+			(name, sep, params) = item.partition(";")
+			q = re.search(r"\bq\s*=\s*([0-9.]+)", params)
+			try:
+				weights[name.strip().lower()] = float(q.group(1)) if q else 1.0
+			except ValueError:
+				continue
+		best = (0, None)
+		for encoding in COMPRESS:
+			q = weights.get(encoding, weights.get("*", 0))
+			if q > best[0]:
+				best = (q, encoding)
+		return best[1]
+
+	@staticmethod
+	def compress(accept, response, data, headers):
+		#successful responses of COMPRESS_MIN bytes or more, and all streams, vary by
+		#encoding. Each compressed response gets its own ETag, and is cached along with
+		#the original when that was.
+		if response != 200 or (isinstance(data, (str, bytes)) and len(data) < COMPRESS_MIN):
+			return(response, data, headers)
+		headers = dict(headers, Vary="Accept-Encoding")
+		encoding = PhoneBook.encoding(accept)
+		if not encoding:
+			return(response, data, headers)
+		headers["Content-Encoding"] = encoding
+		if not isinstance(data, (str, bytes)):
+			return(response, compress_stream(data, encoding), headers)
+		if isinstance(data, str):
+			data = bytes(data, "utf-8")
+		if not "ETag" in headers:
+			return(response, compress(data, encoding), headers)
+		headers["ETag"] = '"%s-%s"' % (headers["ETag"].strip('"'), encoding)
+		return cache.remember(("compressed", headers["ETag"]), lambda: (response, compress(data, encoding), headers))
+
 	@classmethod
-	def handle_get(cls):
-		#there is only one get
-		return cls.list_all()
+	def handle_get(cls, path, headers):
+		url = urllib.parse.urlsplit(path)
+		if url.path == "/cache":
+			return(200, encode(cache.stats()))
+		if url.path == "/metrics":
+			return(200, metrics.render(), {"Content-type": "text/plain; version=0.0.4"})
+		query = dict(urllib.parse.parse_qsl(url.query))
+		if url.path == "/profile":
+			return cls.profile(query)
+		if url.path == "/slow":
+			if not slow.threshold > 0:
+				return(404, "Slow query log is off.")
+			return(200, encode(slow.report()))
+		if url.path == "/suggest":
+			return cls.suggest(query)
+		if url.path == "/lookup":
+			if not query.get("number"):
+				return(400, "Missing compulsory field.")
+			found = cls.lookup([query["number"]])[0]
+			return(200, encode_rows(found)) if found else (404, "")
+		if url.path == "/export":
+			format = query.get("format", "ndjson")
+			if not format in PhoneBook.FORMATS:
+				return(400, "Unsupported format.")
+			return(200, PhoneBook.dump(format), {"Content-type": PhoneBook.FORMATS[format]})
+		if url.path == "/changes":
+			return cls.changes(query, headers)
+		#otherwise there is only one get, though it can be paged or streamed
+		return cls.list_all(query)
+
+	@staticmethod
+	def profile(query):
+		#the sampled requests' stats as text, or for python3 -m pstats with format=pstats
+		if not profiler.sample > 0:
+			return(404, "Profiling is off.")
+		if query.get("format") == "pstats":
+			data = profiler.dump()
+			return(200, data, {"Content-type": "application/octet-stream"}) if data else (204, "")
+		sort = query.get("sort", "cumulative")
+		try:
+			limit = int(query.get("limit", 50))
+		except ValueError:
+			return(400, "Bad request data.")
+		if not sort in Profiler.SORTS or limit < 1:
+			return(400, "Bad request data.")
+		text = profiler.render(sort, limit)
+		return(200, text, {"Content-type": "text/plain; charset=utf-8"}) if text else (204, "")
+
+	@staticmethod
+	def suggest(query):
+		try:
+			prefix = query["prefix"]
+		except KeyError:
+			return(400, "Missing compulsory field.")
+		try:
+			limit = min(int(query.get("limit", 10)), MAX_SUGGEST)
+		except ValueError:
+			return(400, "Bad request data.")
+		if not prefix or limit < 1:
+			return(400, "Bad request data.")
+		for lists in suggestions:
+			lists.check()
+		if len(suggestions) == 1:
+			return(200, encode(suggestions[0].lookup(prefix, limit)))
+		return(200, encode(Suggestions.combine([lists.lookup(prefix, limit) for lists in suggestions], limit)))
+
+	@staticmethod
+	def changes(query, headers):
+		#the changes after since, waiting up to wait seconds for there to be some, or
+		#streamed as server sent events to clients which accept them. A long poll turned
+		#away by the limit of waiters gets its changes if there are any and a 503 if not.
+		(error, request) = PhoneBook.check_changes(query, headers)
+		if error:
+			return error
+		(since, limit, wait, stream) = request
+		if stream:
+			if since is None:
+				since = feed.read(None, limit)[1]
+			return(200, feed.events(since, wait), dict(PhoneBook.EVENT_STREAM))
+		with feed.slot() as waiting:
+			found = feed.wait(since, limit, wait if waiting else 0)
+		if not waiting and wait > 0 and found is not None and not found[0]:
+			metrics.shed("waiters")
+			return(503, "Server busy.", {"Retry-After": str(RETRY_AFTER)})
+		return PhoneBook.found_changes(found)
+
+	@staticmethod
+	def check_changes(query, headers):
+		#gives an error response or (since, limit, wait, stream) for a /changes request
+		try:
+			since = headers.get("Last-Event-ID") or query.get("since")
+			since = None if since is None else feed.parse(since)
+			stream = "text/event-stream" in headers.get("Accept", "")
+			wait = min(float(query.get("wait", MAX_WAIT if stream else 0)), MAX_WAIT)
+			limit = min(int(query.get("limit", MAX_PAGE)), MAX_PAGE)
+		except ValueError:
+			return((400, "Bad request data."), None)
+		if not wait >= 0 or limit < 1:
+			return((400, "Bad request data."), None)
+		return(None, (since, limit, wait, stream))
+
+	@staticmethod
+	def found_changes(found):
+		if found is None:
+			return(410, "Changes no longer available.")
+		return(200, encode({"changes": found[0], "last": feed.format(found[1])}))
 
 	@classmethod
 	def handle_post(cls, path, data):
-		cmd = path.split("/")[1]
+		cmd = (urllib.parse.urlsplit(path).path.split("/") + [""])[1]
+		if REPLICA and cmd in ("create", "remove", "update", "bulk", "import"):
+			return(403, "Read only replica.")
 		if cmd == "create":
 			return cls.create(data)
 		if cmd == "remove":
@@ -24,108 +1770,475 @@ class PhoneBook():
 			return cls.update(data)
 		if cmd == "search":
 			return cls.search(data)
+		if cmd == "bulk":
+			return cls.bulk(path, data)
+		if cmd == "lookup":
+			return cls.lookup_many(data)
+		if cmd == "import":
+			return cls.import_entries(path, data)
 		return(404, "Unknown action.");
 
 	@staticmethod
-	def list_all():
-		c = db.execute("SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC;")
-		data = []
-		for row in c:
-			data.append({"surname": row[0], "firstname": row[1], "number": row[2], "address": row[3]})
-		if len(data) == 0:
+	def list_all(query={}):
+		if "limit" in query or "after" in query:
+			return cache.fetch(("page", query.get("after"), query.get("limit")), lambda: PhoneBook.list_page(query))
+		if STREAM or query.get("stream") == "1":
+			return PhoneBook.list_stream()
+		return cache.fetch(("list",), PhoneBook.list_rows)
+
+	@staticmethod
+	def list_rows():
+		if REPLICA:
+			snapshot = replica.current()
+			return(200, snapshot.listing()) if len(snapshot) else (204, "")
+		data = PhoneBook.select(lambda pool, db: ("SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;", ()))
+		if data == b"[]":
+			return(204, "")
+		return(200, data)
+
+	@staticmethod
+	def select(statement, offset=0, limit=None):
+		#a json array of the rows statement(pool, db) gives the (sql, params) for on each
+		#shard, merged into surname order and cut down to limit after offset
+		if shards.count == 1:
+			pool = shards.pools[0]
+			with pool.reader() as db:
+				return query_rows(db, *statement(pool, db))
+		def fetch(shard):
+			pool = shards.pools[shard]
+			with pool.reader() as db:
+				return db.execute(*statement(pool, db)).fetchall()
+		rows = shards.merge(shards.map(fetch))
+		return encode_rows(itertools.islice(rows, offset, None if limit is None else offset + limit))
+
+	@staticmethod
+	def list_page(query):
+		#keyset pagination, after is the surname and rowid of the last entry seen, a rowid
+		#being in whichever shard has the surname
+		try:
+			limit = min(int(query.get("limit", MAX_PAGE)), MAX_PAGE)
+			if "after" in query:
+				(after_surname, after_rowid) = query["after"].rsplit(",", 1)
+				after_rowid = int(after_rowid)
+		except ValueError:
+			return(400, "Bad request data.")
+		if limit < 1:
+			return(400, "Bad request data.")
+		if REPLICA:
+			(data, after) = replica.current().page((after_surname, after_rowid) if "after" in query else None, limit)
+			return(200, b'{"entries": ' + data + b', "after": ' + encode(after) + b'}')
+		def page(shard):
+			with shards.pools[shard].reader() as db, metrics.stage("sql"):
+				if "after" in query:
+					c = db.execute("SELECT rowid, surname, firstname, number, address FROM phonebook WHERE (surname, rowid) > (?, ?) ORDER BY surname ASC, rowid ASC LIMIT ?;",
+						(after_surname, after_rowid, limit))
+				else:
+					c = db.execute("SELECT rowid, surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC LIMIT ?;", (limit,))
+				return c.fetchall()
+		rows = list(itertools.islice(shards.merge(shards.map(page), 1), limit))
+		after = None
+		if len(rows) == limit:
+			after = "%s,%d" % (rows[-1][1], rows[-1][0])
+		return(200, b'{"entries": ' + encode_rows(row[1:] for row in rows) + b', "after": ' + encode(after) + b'}')
+
+	@staticmethod
+	def list_stream():
+		if REPLICA:
+			chunks = replica.current().stream()
+		else:
+			chunks = PhoneBook.stream_json("SELECT surname, firstname, number, address FROM phonebook ORDER BY surname ASC, rowid ASC;", ())
+		first = next(chunks, None)
+		if first is None:
 			return(204, "")
-		return(200, json.dumps(data))
+		return(200, PhoneBook.prepend(first, chunks))
+
+	@staticmethod
+	def stream_json(sql, params):
+		#yields the json array a batch of rows at a time, or nothing at all if there are no rows,
+		#from a connection of its own on each shard until it is exhausted or closed
+		with contextlib.ExitStack() as stack:
+			cursors = [stack.enter_context(pool.streamer()).execute(sql, params) for pool in shards.pools]
+			if len(cursors) == 1:
+				batches = PhoneBook.batches(cursors[0])
+			else:
+				merged = shards.merge([itertools.chain.from_iterable(PhoneBook.batches(c)) for c in cursors])
+				batches = iter(lambda: list(itertools.islice(merged, STREAM_BATCH)), [])
+			sep = b"["
+			for rows in batches:
+				yield sep + encode_rows(rows)[1:-1]
+				sep = b", "
+			if sep != b"[":
+				yield b"]"
+
+	@staticmethod
+	def batches(c):
+		while True:
+			with metrics.stage("sql"):
+				rows = c.fetchmany(STREAM_BATCH)
+			if not rows:
+				return
+			yield rows
+
+	@staticmethod
+	def prepend(first, rest):
+		try:
+			yield first
+			yield from rest
+		finally:
+			rest.close()
+
+	@staticmethod
+	def write(work):
+		#applies (func, params) pairs and gives back their results, in one transaction on
+		#a single shard. Otherwise each shard's share goes in a transaction of its own on
+		#that shard, all of them in parallel, and an update to a surname on another shard
+		#is a move which waits for everything before it and holds up everything after.
+		if shards.count == 1:
+			return PhoneBook.write_shard(0, work)
+		results = [None] * len(work)
+		parts = {}
+		def flush():
+			batch = dict(parts)
+			parts.clear()
+			if not batch:
+				return
+			done = shards.map(lambda shard: PhoneBook.write_shard(shard, [(func, params) for (i, func, params) in batch[shard]]), list(batch))
+			for (shard, outcome) in zip(batch, done):
+				for ((i, func, params), result) in zip(batch[shard], outcome):
+					if func is PhoneBook.insert_many:
+						result = (201, results[i][1] + result[1])
+					results[i] = result
+		for (i, (func, params)) in enumerate(work):
+			if func is PhoneBook.insert_many:
+				results[i] = (201, 0)
+				rows = collections.defaultdict(list)
+				for row in params:
+					rows[shards.owner(row[0])].append(row)
+				for (shard, part) in rows.items():
+					parts.setdefault(shard, []).append((i, func, part))
+			elif func is PhoneBook.change and shards.owner(params[0]) != shards.owner(params[4]):
+				flush()
+				results[i] = PhoneBook.move(params)
+			else:
+				#an update within a shard has the new surname's owner as well as the old one's
+				parts.setdefault(shards.owner(params[0]), []).append((i, func, params))
+		flush()
+		return results
+
+	@staticmethod
+	def move(params):
+		#an update's new entry is inserted in its shard before the old one is deleted from
+		#its own, so a dupe leaves the entry where it was, and the insert is taken back if
+		#the old one has gone in the meantime. A crash in between leaves both. The change
+		#log has it as a create and a remove.
+		(new, old) = (params[:4], params[4:])
+		with shards.pools[shards.owner(old[0])].reader() as db, metrics.stage("sql"):
+			if not db.execute("SELECT 1 FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=?;", old).fetchone():
+				return(404, "No such entry.")
+		result = PhoneBook.write_shard(shards.owner(new[0]), [(PhoneBook.insert, new)])[0]
+		if result[0] != 201:
+			return result
+		result = PhoneBook.write_shard(shards.owner(old[0]), [(PhoneBook.delete, old)])[0]
+		if result[0] != 201:
+			PhoneBook.write_shard(shards.owner(new[0]), [(PhoneBook.delete, new)])
+		return result
+
+	@staticmethod
+	def write_shard(shard, work):
+		#applies (func, params) pairs in one transaction on a shard and gives back their
+		#results, moves the cache on to a new generation if anything actually changed and
+		#passes the names added and taken away on to the shard's suggestions
+		def run(db):
+			before = db.total_changes
+			results = [func(db, params) for (func, params) in work]
+			changed = db.total_changes != before
+			if changed:
+				db.execute("DELETE FROM phonebook_changes WHERE seq <= (SELECT MAX(seq) FROM phonebook_changes) - ?;", (CHANGES_KEEP,))
+			return(results, changed)
+		def after(db, outcome):
+			removed = []
+			added = []
+			rebuild = False
+			for ((func, params), result) in zip(work, outcome[0]):
+				if result[0] != 201:
+					continue
+				if func is PhoneBook.insert_many:
+					#no telling which of them were dupes
+					rebuild = True
+				elif func is PhoneBook.insert:
+					added.append(params[:2])
+				elif func is PhoneBook.delete:
+					removed.append(params[:2])
+				else:
+					removed.append(params[4:6])
+					added.append(params[:2])
+			suggestions[shard].change(db, removed, added, rebuild)
+		with metrics.stage("sql"):
+			(results, changed) = shards.pools[shard].write(run, after)
+		if changed:
+			cache.invalidate()
+			feed.notify()
+		return results
 
 	@staticmethod
 	def create(data):
 		try:
-			entry = json.loads(data)
+			entry = decode(data)
 		except ValueError:
 			return(400, "Bad request data.")
+		(error, params) = PhoneBook.check_create(entry)
+		if error:
+			return error
+		return PhoneBook.write([(PhoneBook.insert, params)])[0]
+
+	@staticmethod
+	def check_create(entry):
+		#gives an error response or the parameters for insert
 		if not type(entry) is dict:
-			return(400, "Bad request data.")
+			return((400, "Bad request data."), None)
 		try:
 			surname = entry["surname"]
 			firstname = entry["firstname"]
 			number = entry["number"]
 		except KeyError:
-			return(400, "Missing compulsory field.")
+			return((400, "Missing compulsory field."), None)
 		if not surname or not firstname or not number:
-			return(400, "Missing compulsory field.")
+			return((400, "Missing compulsory field."), None)
 		address = ""
 		if "address" in entry.keys():
 			address = entry["address"]
-		
-		#check for dupes
-		c = db.execute("SELECT EXISTS(SELECT 1 FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=? LIMIT 1);", (surname, firstname, number, address))
-		if not c.fetchone() == (0,):
-			return(409, "Duplicate entry.");
+		#anything but text would only go wrong after it's been written
+		if any(not field is None and not type(field) is str for field in (surname, firstname, number, address)):
+			return((400, "Bad request data."), None)
+		return(None, (surname, firstname, number, address))
 
-		c = db.execute("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?);", (surname, firstname, number, address))
-		db.commit()
+	@staticmethod
+	def insert(db, params):
+		#the unique index turns dupes into a no-op
+		c = db.execute("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING;", params)
+		if c.rowcount == 0:
+			return(409, "Duplicate entry.");
 		return(201, "")
 
 	@staticmethod
 	def remove(data):
 		try:
-			entry = json.loads(data)
+			entry = decode(data)
 		except ValueError:
 			return(400, "Bad request data.")
+		(error, params) = PhoneBook.check_remove(entry)
+		if error:
+			return error
+		return PhoneBook.write([(PhoneBook.delete, params)])[0]
+
+	@staticmethod
+	def check_remove(entry):
 		if not type(entry) is dict:
-			return(400, "Bad request data.")
+			return((400, "Bad request data."), None)
 		try:
 			surname = entry["surname"]
 			firstname = entry["firstname"]
 			number = entry["number"]
 			address = entry["address"]
 		except KeyError:
-			return(400, "Missing compulsory field.")
+			return((400, "Missing compulsory field."), None)
 		if not surname or not firstname or not number:
-			return(400, "Missing compulsory field.")
-		
-		#check entry exists
-		c = db.execute("SELECT EXISTS(SELECT 1 FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=? LIMIT 1);", (surname, firstname, number, address))
-		if not c.fetchone() == (1,):
-			return(404, "No such entry.");
+			return((400, "Missing compulsory field."), None)
+		if any(not field is None and not type(field) is str for field in (surname, firstname, number, address)):
+			return((400, "Bad request data."), None)
+		return(None, (surname, firstname, number, address))
 
-		c = db.execute("DELETE FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=?;", (surname, firstname, number, address))
-		db.commit()
+	@staticmethod
+	def delete(db, params):
+		c = db.execute("DELETE FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=?;", params)
+		if c.rowcount == 0:
+			return(404, "No such entry.");
 		return(201, "")
 	
 	@staticmethod
 	def search(data):
+		#any of the fields, each either a string to look for anywhere in it or one of
+		#{"exact": ...}, {"prefix": ...} or {"substring": ...}, with optional limit,
+		#offset and explain
 		try:
-			entry = json.loads(data)
+			entry = decode(data)
 		except ValueError:
 			return(400, "Bad request data.")
 		if not type(entry) is dict:
 			return(400, "Bad request data.")
-		try:
-			surname = entry.pop("surname")
-		except KeyError:
-			return(400, "Missing compulsory field.")
-		if not surname:
+		limit = entry.pop("limit", None)
+		offset = entry.pop("offset", 0)
+		explain = entry.pop("explain", False)
+		if limit is not None and (not type(limit) is int or limit < 1):
+			return(400, "Bad request data.")
+		if not type(offset) is int or offset < 0 or not type(explain) is bool:
+			return(400, "Bad request data.")
+		terms = []
+		for (field, value) in entry.items():
+			if not field in PhoneBook.SEARCH_FIELDS:
+				return(400, "Unsupported field.")
+			mode = "substring"
+			if type(value) is dict and len(value) == 1:
+				(mode, value) = value.popitem()
+				if not mode in PhoneBook.SEARCH_MODES:
+					return(400, "Bad request data.")
+			if not type(value) is str:
+				return(400, "Bad request data.")
+			if not value:
+				return(400, "Missing compulsory field.")
+			terms.append((field, mode, value))
+		if not terms:
 			return(400, "Missing compulsory field.")
-		if len(entry) > 0:
-			return(400, "Unsupported field.")
-		
-		#search
-		c = db.execute("SELECT surname, firstname, number, address FROM phonebook WHERE surname LIKE '%' || ? || '%' ORDER BY surname ASC;", (surname,))
-		data = []
-		for row in c:
-			data.append({"surname": row[0], "firstname": row[1], "number": row[2], "address": row[3]})
-		if len(data) == 0:
+
+		#LIKE only folds ASCII case, so neither may the cache key
+		if terms[0][:2] == ("surname", "substring") and len(terms) == 1 and limit is None and offset == 0 and not explain:
+			surname = terms[0][2]
+			return cache.fetch(("search", surname.translate(ASCII_LOWER)), lambda: PhoneBook.find(surname))
+		key = tuple(sorted((field, mode, value if mode == "exact" else value.translate(ASCII_LOWER)) for (field, mode, value) in terms))
+		return cache.fetch(("query", key, limit, offset, explain), lambda: PhoneBook.query(terms, limit, offset, explain))
+
+	@staticmethod
+	def lookup(numbers):
+		#the entries for each number through the index on the normalised number
+		sql = "SELECT surname, firstname, number, address FROM phonebook WHERE e164 = (%s) ORDER BY surname ASC, rowid ASC;" % e164("?1")
+		def lookup(shard):
+			with shards.pools[shard].reader() as db, metrics.stage("sql"):
+				return [db.execute(sql, (number,)).fetchall() for number in numbers]
+		found = shards.map(lookup)
+		if len(found) == 1:
+			return found[0]
+		return [list(shards.merge(rows)) for rows in zip(*found)]
+
+	@staticmethod
+	def lookup_many(data):
+		#a json array of numbers, answered with a dictionary of the entries for each
+		try:
+			numbers = decode(data)
+		except ValueError:
+			return(400, "Bad request data.")
+		if not type(numbers) is list or not numbers or len(numbers) > MAX_LOOKUP:
+			return(400, "Bad request data.")
+		if not all(type(number) is str and number for number in numbers):
+			return(400, "Bad request data.")
+		found = PhoneBook.lookup(numbers)
+		return(200, encode(dict((number, [{"surname": row[0], "firstname": row[1], "number": row[2], "address": row[3]} for row in rows])
+			for (number, rows) in zip(numbers, found))))
+
+	@staticmethod
+	def plan(pool, db, terms):
+		#every index a term could use, with a count of the rows it leads to up to
+		#PLAN_SAMPLE, smallest first. Exact and prefix terms have a case folding index
+		#on their column and substrings of three or more characters the trigram index.
+		candidates = []
+		for (field, mode, value) in terms:
+			if mode == "exact":
+				index = "phonebook_%s_nocase" % field
+				sql = "SELECT 1 FROM phonebook INDEXED BY %s WHERE %s = ? COLLATE NOCASE" % (index, field)
+				param = value
+			elif mode == "prefix" and not value[0] in "%_":
+				index = "phonebook_%s_nocase" % field
+				sql = "SELECT 1 FROM phonebook INDEXED BY %s WHERE %s LIKE ?" % (index, field)
+				param = value + "%"
+			elif mode == "substring" and SEARCH == "fts" and field != "address" and len(value) >= 3 and migrations.applied(index_trigrams, pool, db):
+				index = "phonebook_fts"
+				sql = "SELECT 1 FROM phonebook_fts WHERE %s LIKE ?" % field
+				param = "%" + value + "%"
+			else:
+				continue
+			try:
+				with metrics.stage("sql"):
+					rows = db.execute("SELECT count(*) FROM (%s LIMIT ?);" % sql, (param, PLAN_SAMPLE)).fetchone()[0]
+			except sqlite3.OperationalError:
+				#an index the database doesn't have, say a replica of an older one
+				continue
+			candidates.append({"field": field, "mode": mode, "index": index, "rows": rows})
+		candidates.sort(key=lambda candidate: candidate["rows"])
+		return candidates
+
+	@staticmethod
+	def query(terms, limit, offset, explain):
+		#each shard plans its own query and gives its first offset + limit rows, which
+		#are merged before skipping offset of them
+		if explain:
+			def explain_shard(shard):
+				pool = shards.pools[shard]
+				with pool.reader() as db:
+					(sql, params, candidates) = PhoneBook.statement(pool, db, terms, limit, offset)
+					with metrics.stage("sql"):
+						steps = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+				return {"index": candidates[0]["index"] if candidates else None, "candidates": candidates, "sql": sql, "plan": steps}
+			plans = shards.map(explain_shard)
+			return(200, encode(plans[0] if len(plans) == 1 else plans))
+		if shards.count == 1:
+			data = PhoneBook.select(lambda pool, db: PhoneBook.statement(pool, db, terms, limit, offset)[:2])
+		else:
+			data = PhoneBook.select(lambda pool, db: PhoneBook.statement(pool, db, terms, None if limit is None else offset + limit, 0)[:2], offset, limit)
+		if data == b"[]":
 			return(404, "")
-		return(200, json.dumps(data))
+		return(200, data)
+
+	@staticmethod
+	def statement(pool, db, terms, limit, offset):
+		#(sql, params, candidates) for a search on one shard. Every term is applied as a
+		#filter, the planner only decides which one leads the way in through its index.
+		where = []
+		params = []
+		for (field, mode, value) in terms:
+			if mode == "exact":
+				where.append("%s = ?" % field)
+				params.append(value)
+			else:
+				where.append("%s LIKE ?" % field)
+				params.append(value + "%" if mode == "prefix" else "%" + value + "%")
+		candidates = PhoneBook.plan(pool, db, terms)
+		source = "phonebook"
+		if candidates:
+			best = candidates[0]
+			(field, mode) = (best["field"], best["mode"])
+			value = [term[2] for term in terms if term[0] == field][0]
+			if best["index"] == "phonebook_fts":
+				where.insert(0, "rowid IN (SELECT rowid FROM phonebook_fts WHERE %s LIKE ?)" % field)
+				params.insert(0, "%" + value + "%")
+			else:
+				source = "phonebook INDEXED BY " + best["index"]
+				if mode == "exact":
+					where.insert(0, "%s = ? COLLATE NOCASE" % field)
+					params.insert(0, value)
+		sql = "SELECT surname, firstname, number, address FROM %s WHERE %s ORDER BY surname ASC, rowid ASC LIMIT ? OFFSET ?;" % (source, " AND ".join(where))
+		params += [-1 if limit is None else limit, offset]
+		return(sql, params, candidates)
+
+	@staticmethod
+	def find(surname):
+		#the trigram index needs three characters to narrow anything down and
+		#the LIKE is repeated so results match a scan exactly
+		if REPLICA:
+			data = replica.current().find(surname)
+			return(404, "") if data == b"[]" else (200, data)
+		def statement(pool, db):
+			if SEARCH == "fts" and len(surname) >= 3 and migrations.applied(index_trigrams, pool, db):
+				return("SELECT surname, firstname, number, address FROM phonebook WHERE rowid IN (SELECT rowid FROM phonebook_fts WHERE surname LIKE '%' || ? || '%') AND surname LIKE '%' || ? || '%' ORDER BY surname ASC, rowid ASC;", (surname, surname))
+			return("SELECT surname, firstname, number, address FROM phonebook WHERE surname LIKE '%' || ? || '%' ORDER BY surname ASC, rowid ASC;", (surname,))
+		data = PhoneBook.select(statement)
+		if data == b"[]":
+			return(404, "")
+		return(200, data)
 
 	@staticmethod
 	def update(data):
 		try:
-			entry = json.loads(data)
+			entry = decode(data)
 		except ValueError:
 			return(400, "Bad request data.")
+		(error, params) = PhoneBook.check_update(entry)
+		if error:
+			return error
+		return PhoneBook.write([(PhoneBook.change, params)])[0]
+
+	@staticmethod
+	def check_update(entry):
 		if not type(entry) is dict:
-			return(400, "Bad request data.")
+			return((400, "Bad request data."), None)
 		try:
 			surname = entry["surname"]
 			firstname = entry["firstname"]
@@ -136,73 +2249,1049 @@ class PhoneBook():
 			newnumber = entry["newnumber"]
 			newaddress = entry["newaddress"]
 		except KeyError:
-			return(400, "Missing compulsory field.")
+			return((400, "Missing compulsory field."), None)
 		if not surname or not newsurname or not firstname or not newfirstname or not number or not newnumber:
-			return(400, "Missing compulsory field.")
+			return((400, "Missing compulsory field."), None)
+		if newaddress is None:
+			return((400, "Bad request data."), None)
+		if any(not field is None and not type(field) is str for field in (newsurname, newfirstname, newnumber, newaddress, surname, firstname, number, address)):
+			return((400, "Bad request data."), None)
+		return(None, (newsurname, newfirstname, newnumber, newaddress, surname, firstname, number, address))
 
-		#check entry exists
-		c = db.execute("SELECT EXISTS(SELECT 1 FROM phonebook WHERE surname=? AND firstname=? AND number=? AND address=? LIMIT 1);", (surname, firstname, number, address))
-		if not c.fetchone() == (1,):
+	@staticmethod
+	def change(db, params):
+		try:
+			c = db.execute("UPDATE phonebook SET surname=?, firstname=?, number=?, address=? WHERE surname=? AND firstname=? AND number=? AND address=?;", params)
+		except sqlite3.IntegrityError as e:
+			#it would become a copy of another entry, any other constraint is a bug
+			if not str(e).startswith("UNIQUE constraint failed"):
+				raise
+			return(409, "Duplicate entry.");
+		if c.rowcount == 0:
 			return(404, "No such entry.");
-
-		#change it
-		c = db.execute("UPDATE phonebook SET surname=?, firstname=?, number=?, address=? WHERE surname=? AND firstname=? AND number=? AND address=?;",
-			(newsurname, newfirstname, newnumber, newaddress, surname, firstname, number, address))
-		db.commit()
 		return(201, "")
 
+	@staticmethod
+	def bulk(path, data):
+		#a json array or one json object per line, each with an "op" of create, remove or update
+		query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+		try:
+			batch = int(query.get("batch", BULK_BATCH))
+		except ValueError:
+			return(400, "Bad request data.")
+		if batch < 1:
+			return(400, "Bad request data.")
+		if data.lstrip().startswith("["):
+			try:
+				items = decode(data)
+			except ValueError:
+				return(400, "Bad request data.")
+		else:
+			items = []
+			for line in data.splitlines():
+				if not line.strip():
+					continue
+				try:
+					items.append(decode(line))
+				except ValueError:
+					items.append(None)
+		if len(items) == 0:
+			return(400, "Bad request data.")
+
+		#everything is checked up front so only real writes go to the writer
+		results = []
+		work = []
+		for item in items:
+			if not type(item) is dict:
+				results.append((400, "Bad request data."))
+				continue
+			item = dict(item)
+			op = item.pop("op", None)
+			if not type(op) is str or not op in PhoneBook.BULK_OPS:
+				results.append((404, "Unknown action."))
+				continue
+			op = PhoneBook.BULK_OPS[op]
+			(error, params) = op[0](item)
+			if error:
+				results.append(error)
+				continue
+			results.append(None)
+			work.append((len(results) - 1, op[1], params))
+
+		#one transaction per batch
+		for start in range(0, len(work), batch):
+			chunk = work[start:start + batch]
+			done = PhoneBook.write([(func, params) for (i, func, params) in chunk])
+			for ((i, func, params), result) in zip(chunk, done):
+				results[i] = result
+
+		data = []
+		for (status, message) in results:
+			if message:
+				data.append({"status": status, "error": message})
+			else:
+				data.append({"status": status})
+		return(200, encode(data))
+
+	@staticmethod
+	def import_entries(path, data):
+		#NDJSON, or CSV with a header row, added like create but BULK_BATCH to a transaction
+		#as the body arrives
+		query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+		format = query.get("format", "ndjson")
+		if not format in PhoneBook.FORMATS:
+			return(400, "Unsupported format.")
+		lines = io.TextIOWrapper(io.BufferedReader(data, 64 * 1024), encoding="utf-8", newline="")
+		return(200, encode(PhoneBook.load(PhoneBook.read_entries(lines, format))))
+
+	@staticmethod
+	def read_entries(lines, format):
+		#yields entries as they are read, None for any line which isn't one
+		if format == "csv":
+			yield from csv.DictReader(lines, restval="")
+			return
+		for line in lines:
+			if not line.strip():
+				continue
+			try:
+				yield decode(line)
+			except ValueError:
+				yield None
+
+	@staticmethod
+	def load(entries, progress=None):
+		#checks and inserts entries a batch at a time so memory stays flat however many
+		#there are, and counts what happened to them
+		report = {"read": 0, "imported": 0, "duplicates": 0, "invalid": 0, "errors": []}
+		start = time.perf_counter()
+		batch = []
+		for entry in entries:
+			report["read"] += 1
+			(error, params) = PhoneBook.check_create(entry)
+			if not error and None in params:
+				error = (400, "Bad request data.")
+			if error:
+				report["invalid"] += 1
+				if len(report["errors"]) < MAX_IMPORT_ERRORS:
+					report["errors"].append({"entry": report["read"], "status": error[0], "error": error[1]})
+				continue
+			batch.append(params)
+			if len(batch) == BULK_BATCH:
+				report["imported"] += PhoneBook.write([(PhoneBook.insert_many, batch)])[0][1]
+				batch = []
+				if progress:
+					progress(report["read"], time.perf_counter() - start)
+		if batch:
+			report["imported"] += PhoneBook.write([(PhoneBook.insert_many, batch)])[0][1]
+		seconds = time.perf_counter() - start
+		report["duplicates"] = report["read"] - report["invalid"] - report["imported"]
+		report["seconds"] = round(seconds, 3)
+		report["rows_per_sec"] = int(report["read"] / seconds) if seconds else 0
+		return report
+
+	@staticmethod
+	def insert_many(db, rows):
+		c = db.executemany("INSERT INTO phonebook (surname, firstname, number, address) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING;", rows)
+		return(201, c.rowcount)
+
+	@staticmethod
+	def dump(format, progress=None):
+		#yields the whole table in the order it was written a batch at a time, one shard
+		#after another, from a connection of its own until it is exhausted or closed
+		start = time.perf_counter()
+		count = 0
+		if format == "csv":
+			yield b"surname,firstname,number,address\r\n"
+		for pool in shards.pools:
+			with pool.streamer() as db:
+				c = db.execute("SELECT surname, firstname, number, address FROM phonebook ORDER BY rowid ASC;")
+				for rows in PhoneBook.batches(c):
+					with metrics.stage("serialize"):
+						if format == "csv":
+							out = io.StringIO()
+							csv.writer(out).writerows(rows)
+							yield bytes(out.getvalue(), "utf-8")
+						else:
+							yield bytes("\n".join(map(json_row, itertools.repeat(None), rows)) + "\n", "utf-8")
+					count += len(rows)
+					if progress:
+						progress(count, time.perf_counter() - start)
+
+PhoneBook.FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+PhoneBook.SEARCH_FIELDS = ("surname", "firstname", "number", "address")
+PhoneBook.SEARCH_MODES = ("exact", "prefix", "substring")
+PhoneBook.BULK_OPS = {
+	"create": (PhoneBook.check_create, PhoneBook.insert),
+	"remove": (PhoneBook.check_remove, PhoneBook.delete),
+	"update": (PhoneBook.check_update, PhoneBook.change),
+}
+
 class PhoneBookHTTPHandler(http.server.BaseHTTPRequestHandler):
 
+	protocol_version = "HTTP/1.1"
+	timeout = READ_TIMEOUT
+
+	def handle(self):
+		#as BaseHTTPRequestHandler, but between requests the connection idles in the
+		#server where it can be evicted
+		self.handle_one_request()
+		while not self.close_connection:
+			if not self.buffered() and not self.server.wait_idle(self.connection, KEEPALIVE_TIMEOUT):
+				break
+			self.handle_one_request()
+
+	def handle_one_request(self):
+		#as BaseHTTPRequestHandler's, but the request line and headers are read first and
+		#have to arrive within READ_TIMEOUT in all, rather than between each byte
+		try:
+			try:
+				head = self.read_head()
+			except TimeoutError:
+				self.close_connection = True
+				return self.refuse(408, "Request timeout.")
+			if head is None:
+				self.close_connection = True
+				return self.refuse(431, "Request headers too large.")
+			if not head:
+				self.close_connection = True
+				return
+			self.raw_requestline = head[0]
+			rfile = self.rfile
+			self.rfile = io.BytesIO(b"".join(head[1:]))
+			try:
+				parsed = self.parse_request()
+			finally:
+				self.rfile = rfile
+			if not parsed:
+				return
+			method = getattr(self, "do_" + self.command, None)
+			if not method:
+				self.send_error(http.HTTPStatus.NOT_IMPLEMENTED, "Unsupported method (%r)" % self.command)
+				return
+			method()
+			self.wfile.flush()
+		except TimeoutError as e:
+			self.log_error("Request timed out: %r", e)
+			self.close_connection = True
+
+	def read_head(self):
+		#the request's lines up to and including the blank one, no lines if the client goes
+		#or sends nothing at all, None past MAX_HEAD bytes. Lines are taken out of rfile's
+		#buffer as they arrive, so the body stays in it.
+		deadline = time.monotonic() + READ_TIMEOUT
+		lines = []
+		line = b""
+		size = 0
+		try:
+			while True:
+				self.connection.settimeout(max(deadline - time.monotonic(), 0.001))
+				try:
+					buffered = self.rfile.peek(1)
+				except TimeoutError:
+					if lines or line:
+						raise
+					return []
+				if not buffered:
+					return []
+				end = buffered.find(b"\n")
+				chunk = self.rfile.read1(len(buffered) if end < 0 else end + 1)
+				line += chunk
+				size += len(chunk)
+				if size > MAX_HEAD:
+					return None
+				if line.endswith(b"\n"):
+					lines.append(line)
+					if line in (b"\r\n", b"\n"):
+						return lines
+					line = b""
+		finally:
+			self.connection.settimeout(READ_TIMEOUT)
+
+	def refuse(self, response, message):
+		#a response to a request which never got as far as being parsed
+		self.command = None
+		self.request_version = self.protocol_version
+		self.requestline = ""
+		self.start = time.perf_counter()
+		self.action = "unknown"
+		self.send(response, message, {"Connection": "close"})
+
+	def buffered(self):
+		#whether the next request is already here, pipelined requests will have been
+		#read into the buffer along with the last one
+		self.connection.setblocking(False)
+		try:
+			return bool(self.rfile.peek(1))
+		except OSError:
+			return False
+		finally:
+			self.connection.settimeout(READ_TIMEOUT)
+
+	def receive(self, method, stream=False):
+		#the request body, or a RequestBody to read it from with stream, or None once the
+		#response to a bad one has been sent, any trouble with the body leaves the
+		#connection unusable
+		if "Transfer-Encoding" in self.headers or (method == "POST" and not "Content-Length" in self.headers):
+			return self.send(411, "Length required.", {"Connection": "close"})
+		try:
+			length = int(self.headers.get("Content-Length", 0))
+		except ValueError:
+			length = -1
+		if length < 0:
+			return self.send(400, "Bad request data.", {"Connection": "close"})
+		if stream:
+			return RequestBody(self.read_some, length)
+		if length > MAX_BODY:
+			return self.send(413, "Request too large.", {"Connection": "close"})
+		try:
+			data = self.read_body(length)
+		except TimeoutError:
+			return self.send(408, "Request timeout.", {"Connection": "close"})
+		if data is None:
+			self.close_connection = True
+		return data
+
+	def read_body(self, length):
+		#the whole body within READ_TIMEOUT however slowly it comes, None if the client gives up
+		deadline = time.monotonic() + READ_TIMEOUT
+		chunks = []
+		while length > 0:
+			self.connection.settimeout(max(deadline - time.monotonic(), 0.001))
+			chunk = self.rfile.read1(min(length, 1024 * 1024))
+			if not chunk:
+				return None
+			chunks.append(chunk)
+			length -= len(chunk)
+		self.connection.settimeout(READ_TIMEOUT)
+		return b"".join(chunks)
+
+	def read_some(self, size, timeout):
+		self.connection.settimeout(timeout)
+		try:
+			return self.rfile.read1(size)
+		finally:
+			self.connection.settimeout(READ_TIMEOUT)
+
 	def do_HEAD(self):
 		self.send_response(200)
 		self.send_header("Content-type", "application/json")
 		self.end_headers()
 	
 	def do_GET(self):
-		try:
-			(response, data) = PhoneBook.handle_get()
-		except:
-			response = 500
-			data = "Server Error"
-			print(traceback.format_exc())
+		self.start = time.perf_counter()
+		self.action = PhoneBook.action("GET", self.path)
+		#any body means nothing, but has to be read to get to the next request
+		if self.receive("GET") is not None:
+			self.send(*PhoneBook.handle("GET", self.path, self.headers, b""))
+
+	def do_POST(self):
+		self.start = time.perf_counter()
+		self.action = PhoneBook.action("POST", self.path)
+		if self.action == "import":
+			body = self.receive("POST", stream=True)
+			if body is None:
+				return
+			(response, data, headers) = PhoneBook.handle("POST", self.path, self.headers, body)
+			if body.left:
+				#the rest of the body can't be skipped over to get to the next request
+				headers = dict(headers, Connection="close")
+			return self.send(response, data, headers)
+		data = self.receive("POST")
+		if data is None:
+			return
+		metrics.observe("phonebook_stage_duration_seconds", (("action", self.action), ("stage", "read")), time.perf_counter() - self.start)
+		self.send(*PhoneBook.handle("POST", self.path, self.headers, data))
+
+	def send(self, response, data, headers):
+		start = time.perf_counter()
+		headers = dict(headers)
+		if isinstance(data, str):
+			data = bytes(data, "utf-8")
+		if isinstance(data, bytes):
+			self.send_whole(response, data, headers)
+		else:
+			self.send_stream(response, data, headers)
+		now = time.perf_counter()
+		metrics.observe("phonebook_stage_duration_seconds", (("action", self.action), ("stage", "write")), now - start)
+		metrics.request(self.action, response, now - self.start)
+
+	def send_whole(self, response, data, headers):
 		self.send_response(response)
-		self.send_header("Content-type", "application/json")
-		self.send_header('Content-Length', str(len(data)))
+		self.send_header("Content-type", headers.pop("Content-type", "application/json"))
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		if response != 304:
+			self.send_header('Content-Length', str(len(data)))
 		self.end_headers()
-		self.wfile.write(bytes(data, "utf-8"))
+		self.wfile.write(data)
 
-	def do_POST(self):
+	def log_request(self, code='-', size='-'):
+		if isinstance(code, http.HTTPStatus):
+			code = code.value
+		log.request('%s - - [%s] "%s" %s %s\n' % (self.address_string(), self.log_date_time_string(), self.requestline, str(code), str(size)))
+
+	def log_message(self, format, *args):
+		log.log("%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), format % args))
+
+	def send_stream(self, response, chunks, headers):
+		#the length isn't known up front, HTTP/1.1 clients get it chunked and
+		#anyone else gets the connection closed at the end
+		chunked = self.request_version == "HTTP/1.1"
 		try:
-			data = self.rfile.read(int(self.headers.get("Content-Length"))).decode("utf-8", "strict")
-			(response, backdata) = PhoneBook.handle_post(self.path, data)
-		except UnicodeDecodeError:
-			response = 400
-			data = "Bad request data."
-		except:
-			response = 500
-			data = "Server Error"
+			self.send_response(response)
+			self.send_header("Content-type", headers.pop("Content-type", "application/json"))
+			for (name, value) in headers.items():
+				self.send_header(name, value)
+			if chunked:
+				self.send_header("Transfer-Encoding", "chunked")
+			else:
+				self.send_header("Connection", "close")
+			self.end_headers()
+			for chunk in chunks:
+				if not chunk:
+					continue
+				if chunked:
+					self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+				else:
+					self.wfile.write(chunk)
+			if chunked:
+				self.wfile.write(b"0\r\n\r\n")
+		except (ConnectionError, TimeoutError):
+			#event streams usually end with the client going away
+			self.close_connection = True
+		finally:
+			chunks.close()
+
+class AsyncPhoneBookServer():
+	#one coroutine per connection, so idle keep-alive clients cost no threads
+
+	def __init__(self, server_address, workers):
+		self.server_address = server_address
+		self.workers = workers
+		self.requests = 0
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+	def serve_forever(self):
+		asyncio.run(self.serve())
+
+	async def serve(self):
+		(host, port) = self.server_address
+		server = await asyncio.start_server(self.handle_connection, host or None, port,
+			reuse_address=socketserver.TCPServer.allow_reuse_address, backlog=1024, limit=MAX_HEAD)
+		async with server:
+			await server.serve_forever()
+
+	async def handle_connection(self, reader, writer):
+		loop = asyncio.get_running_loop()
+		try:
+			while True:
+				#pipelined requests simply queue up in the reader and are answered in order. The
+				#connection idles until a request starts, whose head then has READ_TIMEOUT.
+				try:
+					head = await asyncio.wait_for(reader.read(1), KEEPALIVE_TIMEOUT)
+				except asyncio.TimeoutError:
+					break
+				if not head:
+					break
+				try:
+					head += await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+				except asyncio.IncompleteReadError:
+					break
+				except asyncio.LimitOverrunError:
+					writer.write(self.response(431, "Request headers too large.", False))
+					break
+				except asyncio.TimeoutError:
+					writer.write(self.response(408, "Request timeout.", False))
+					break
+				lines = head.decode("latin-1").split("\r\n")
+				try:
+					(method, path, version) = lines[0].split()
+				except ValueError:
+					writer.write(self.response(400, "Bad request.", False))
+					break
+				headers = email.message.Message()
+				for line in lines[1:]:
+					(name, sep, value) = line.partition(":")
+					if sep:
+						headers[name.strip()] = value.strip()
+				start = time.perf_counter()
+				connection = headers.get("Connection", "").lower()
+				if version == "HTTP/1.1":
+					keep_alive = connection != "close"
+				else:
+					keep_alive = connection == "keep-alive"
+				if method == "POST" and ("Transfer-Encoding" in headers or not "Content-Length" in headers):
+					writer.write(self.response(411, "Length required.", False))
+					break
+				try:
+					length = int(headers.get("Content-Length", 0))
+				except ValueError:
+					length = -1
+				if length < 0:
+					writer.write(self.response(400, "Bad request data.", False))
+					break
+				streamed = method == "POST" and PhoneBook.action(method, path) == "import"
+				if streamed:
+					#read from the executor as the entries are loaded
+					data = RequestBody(lambda size, timeout: asyncio.run_coroutine_threadsafe(self.read_some(reader, size, timeout), loop).result(), length)
+				elif length > MAX_BODY:
+					writer.write(self.response(413, "Request too large.", False))
+					break
+				else:
+					try:
+						data = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+					except asyncio.IncompleteReadError:
+						break
+					except asyncio.TimeoutError:
+						writer.write(self.response(408, "Request timeout.", False))
+						break
+				if method == "HEAD":
+					writer.write(self.response(200, "", keep_alive, head_only=True))
+				elif method in ("GET", "POST") and self.requests - self.workers >= MAX_QUEUE:
+					#no more waiting for the executor than the threaded server lets queue for its workers
+					metrics.shed("queue")
+					keep_alive = keep_alive and not streamed
+					writer.write(self.response(503, "Server busy.", keep_alive, {"Retry-After": str(RETRY_AFTER)}))
+				elif method in ("GET", "POST"):
+					action = PhoneBook.action(method, path)
+					if method == "POST" and not streamed:
+						metrics.observe("phonebook_stage_duration_seconds", (("action", action), ("stage", "read")), time.perf_counter() - start)
+					if action == "changes" and method == "GET":
+						(response, backdata, extra) = await self.changes(path, headers)
+					else:
+						self.requests += 1
+						try:
+							(response, backdata, extra) = await loop.run_in_executor(self.executor, PhoneBook.handle, method, path, headers, data)
+						finally:
+							self.requests -= 1
+					if streamed and data.left:
+						#the rest of the body can't be skipped over to get to the next request
+						keep_alive = False
+					written = time.perf_counter()
+					if isinstance(backdata, (str, bytes)):
+						writer.write(self.response(response, backdata, keep_alive, extra))
+						await writer.drain()
+					else:
+						keep_alive = await self.stream(writer, response, backdata, extra, keep_alive and version == "HTTP/1.1")
+					now = time.perf_counter()
+					metrics.observe("phonebook_stage_duration_seconds", (("action", action), ("stage", "write")), now - written)
+					metrics.request(action, response, now - start)
+					log.request('%s - - [%s] "%s" %d -\n' % (writer.get_extra_info("peername")[0],
+						time.strftime("%d/%b/%Y %H:%M:%S"), lines[0], response))
+				else:
+					writer.write(self.response(501, "Unsupported method.", keep_alive))
+				await writer.drain()
+				if not keep_alive:
+					break
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	async def changes(self, path, headers):
+		#waits for changes on the loop rather than holding one of the executor's threads,
+		#which only does the reads. Event streams aren't compressed, compress_stream can't
+		#pull from the loop.
+		loop = asyncio.get_running_loop()
+		read = lambda since, limit: loop.run_in_executor(self.executor, feed.read, since, limit)
+		query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+		try:
+			(error, request) = PhoneBook.check_changes(query, headers)
+			if error:
+				return error + ({},)
+			(since, limit, wait, stream) = request
+			if stream:
+				if since is None:
+					since = (await read(None, limit))[1]
+				return(200, feed.events_async(since, wait, read), dict(PhoneBook.EVENT_STREAM))
+			found = await feed.wait_async(since, limit, wait, read)
+			return PhoneBook.compress(headers.get("Accept-Encoding", ""), *PhoneBook.found_changes(found), {})
+		except Exception:
 			print(traceback.format_exc())
-		self.send_response(response)
-		self.send_header("Content-type", "application/json")
-		self.send_header('Content-Length', str(len(backdata)))
-		self.end_headers()
-		self.wfile.write(bytes(backdata, "utf-8"))
-
-db = sqlite3.connect(DATABASE)
-c = db.execute("SELECT SQLITE_VERSION()")
-print("SQLite version: " + str(c.fetchone()))
-c = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='phonebook'")
-if not c.fetchone():
-	print("Initialising database.")
-	db.execute('''CREATE TABLE phonebook ( 
+			return(500, "Server Error", {})
+
+	@staticmethod
+	async def read_some(reader, size, timeout):
+		try:
+			return await asyncio.wait_for(reader.read(size), timeout)
+		except asyncio.TimeoutError:
+			raise TimeoutError()
+
+	async def stream(self, writer, response, chunks, headers, chunked):
+		#pulls each chunk on the executor as it may be waiting on the database, unless
+		#they come from the loop already. Without chunked encoding the end of the body is
+		#the end of the connection.
+		loop = asyncio.get_running_loop()
+		headers = dict(headers)
+		try:
+			head = "HTTP/1.1 %d %s\r\nContent-type: %s\r\n" % (response, http.HTTPStatus(response).phrase, headers.pop("Content-type", "application/json"))
+			for (name, value) in headers.items():
+				head += "%s: %s\r\n" % (name, value)
+			head += "Transfer-Encoding: chunked\r\n" if chunked else "Connection: close\r\n"
+			writer.write(bytes(head + "\r\n", "latin-1"))
+			while True:
+				if hasattr(chunks, "__anext__"):
+					try:
+						chunk = await chunks.__anext__()
+					except StopAsyncIteration:
+						chunk = None
+				else:
+					chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+				if chunk is None:
+					break
+				if not chunk:
+					continue
+				writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+				await writer.drain()
+			if chunked:
+				writer.write(b"0\r\n\r\n")
+		finally:
+			if hasattr(chunks, "aclose"):
+				await chunks.aclose()
+			else:
+				await loop.run_in_executor(self.executor, chunks.close)
+		return chunked
+
+	@staticmethod
+	def response(response, data, keep_alive, headers={}, head_only=False):
+		body = bytes(data, "utf-8") if isinstance(data, str) else data
+		headers = dict(headers)
+		head = "HTTP/1.1 %d %s\r\nContent-type: %s\r\n" % (response, http.HTTPStatus(response).phrase, headers.pop("Content-type", "application/json"))
+		for (name, value) in headers.items():
+			head += "%s: %s\r\n" % (name, value)
+		if not head_only and response != 304:
+			head += "Content-Length: %d\r\n" % len(body)
+		if not keep_alive:
+			head += "Connection: close\r\n"
+		return bytes(head + "\r\n", "latin-1") + (b"" if head_only or response == 304 else body)
+
+def schema_has(db, type, name):
+	return db.execute("SELECT 1 FROM sqlite_master WHERE type=? AND name=?", (type, name)).fetchone() is not None
+
+#Each migration takes the schema up one version and is called, in a transaction of the
+#writer's, until it returns True for done. False means there is more to do in another
+#transaction and None that it can't be done here and now, which leaves it and everything
+#after it for the next start. Databases from before versioning are at 0, so migrations
+#check for what is already there.
+
+def create_table(db):
+	db.execute('''CREATE TABLE IF NOT EXISTS phonebook ( 
 		surname TEXT NOT NULL,
 		firstname TEXT NOT NULL,
 		number TEXT NOT NULL,
 		address TEXT NOT NULL)''')
-	
-#not protected from stray packets in test mode
-if os.getenv('PHONE_BOOK_TEST'):
-	socketserver.TCPServer.allow_reuse_address = True
+	return True
+
+def unique_index(db, name, columns):
+	#dupes are rare, so they are only looked for when the index can't be built
+	if schema_has(db, "index", name):
+		return
+	try:
+		db.execute("CREATE UNIQUE INDEX %s ON phonebook (%s)" % (name, columns))
+	except sqlite3.IntegrityError:
+		#the first of each lot stays and the rest are moved to phonebook_dupes
+		dupes = "SELECT rowid FROM phonebook WHERE rowid NOT IN (SELECT MIN(rowid) FROM phonebook GROUP BY %s)" % columns
+		db.execute(DUPES_TABLE)
+		for row in db.execute("SELECT surname, firstname, number, address FROM phonebook WHERE rowid IN (%s) ORDER BY rowid" % dupes).fetchall():
+			print("Moving duplicate entry %s to phonebook_dupes." % json_row(None, row))
+		db.execute("INSERT INTO phonebook_dupes SELECT surname, firstname, number, address, ? FROM phonebook WHERE rowid IN (%s)" % dupes, (name,))
+		db.execute("DELETE FROM phonebook WHERE rowid IN (%s)" % dupes)
+		db.execute("CREATE UNIQUE INDEX %s ON phonebook (%s)" % (name, columns))
+
+def index_entries(db):
+	#entries are only ever looked up whole or listed by surname, any dupes which
+	#slipped past the old check have to be moved aside before the unique index can exist
+	unique_index(db, "phonebook_entry", "surname, firstname, number, address")
+	db.execute("CREATE INDEX IF NOT EXISTS phonebook_surname ON phonebook (surname)")
+	return True
+
+def normalise_numbers(db):
+	if not db.execute("SELECT name FROM pragma_table_xinfo('phonebook') WHERE name='e164'").fetchone():
+		db.execute("ALTER TABLE phonebook ADD COLUMN e164 TEXT GENERATED ALWAYS AS (%s) VIRTUAL" % e164("number"))
+	return True
+
+def country_code(db):
+	#the country code the normalised number column was built with, read back from its
+	#definition, or None before there is one
+	row = db.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='phonebook'").fetchone()
+	match = row and re.search(r"THEN '\+([^']+)' \|\| substr", row[0])
+	return match.group(1) if match else None
+
+def index_numbers(db):
+	#the same number written differently is a dupe too, the first one stays and the
+	#others are moved aside
+	unique_index(db, "phonebook_entry_e164", "surname, firstname, e164, address")
+	return True
+
+def index_lookups(db):
+	#lookups scan until it's there
+	db.execute("CREATE INDEX IF NOT EXISTS phonebook_e164 ON phonebook (e164)")
+	return True
+
+def log_changes(db):
+	if not schema_has(db, "table", "phonebook_changes"):
+		for sql in CHANGES_SCHEMA:
+			db.execute(sql)
+	return True
+
+def index_fields(db):
+	#exact and prefix searches on any field, folding case like LIKE does. One index per
+	#transaction, SQLite can't build one a piece at a time, and the planner passes over
+	#any which aren't there yet.
+	for field in ("surname", "firstname", "number", "address"):
+		if not schema_has(db, "index", "phonebook_%s_nocase" % field):
+			db.execute("CREATE INDEX phonebook_{0}_nocase ON phonebook ({0} COLLATE NOCASE)".format(field))
+			return False
+	return True
+
+def index_trigrams(db):
+	#fills the trigram index MIGRATION_BATCH rows at a time in rowid order, searches
+	#scan until it is all there
+	if SEARCH != "fts":
+		return None
+	if not schema_has(db, "table", "phonebook_fts"):
+		try:
+			db.execute(FTS_TABLE)
+		except sqlite3.OperationalError as e:
+			#needs SQLite 3.34 built with FTS5
+			print("No search index, falling back to scans: " + str(e))
+			return None
+		db.execute("CREATE TABLE phonebook_fts_progress (filled INTEGER NOT NULL)")
+		db.execute("INSERT INTO phonebook_fts_progress VALUES (0)")
+		for (row, sql) in FTS_TRIGGERS:
+			db.execute(sql.format(when=FTS_FILLING.format(row=row)))
+		return False
+	if not schema_has(db, "table", "phonebook_fts_progress"):
+		#built whole before versioning
+		return True
+	filled = db.execute("SELECT filled FROM phonebook_fts_progress").fetchone()[0]
+	last = db.execute("SELECT max(rowid) FROM (SELECT rowid FROM phonebook WHERE rowid > ? ORDER BY rowid LIMIT ?)", (filled, MIGRATION_BATCH)).fetchone()[0]
+	if last is None:
+		for name in ("insert", "delete", "update"):
+			db.execute("DROP TRIGGER phonebook_fts_" + name)
+		for (row, sql) in FTS_TRIGGERS:
+			db.execute(sql.format(when=""))
+		db.execute("DROP TABLE phonebook_fts_progress")
+		return True
+	db.execute("INSERT INTO phonebook_fts (rowid, surname, firstname, number) SELECT rowid, surname, firstname, number FROM phonebook WHERE rowid > ? AND rowid <= ?", (filled, last))
+	db.execute("UPDATE phonebook_fts_progress SET filled = ?", (last,))
+	return False
+
+#(what it does, the migration, whether it can wait until the server is up) in version
+#order, anything after the first migration which can wait is run in the background
+MIGRATIONS = [
+	("creating the table", create_table, False),
+	("indexing entries", index_entries, False),
+	("normalising numbers", normalise_numbers, False),
+	("indexing numbers", index_numbers, False),
+	("logging changes", log_changes, False),
+	("indexing numbers for lookups", index_lookups, True),
+	("indexing fields for search", index_fields, True),
+	("building the search index", index_trigrams, True),
+]
+
+class Migrations():
+	#brings the schema of each shard, versioned by PRAGMA user_version, up to date.
+	#Anything quick or which requests can't do without is done before serving and the
+	#rest in the background once the server is up, through the writer a transaction at a
+	#time so requests carry on in between.
+
+	def __init__(self, steps):
+		self.steps = steps
+		self.latest = len(steps)
+		self.versions = dict((step[1], version) for (version, step) in enumerate(steps, 1))
+		self.version = {}
+		self.checked = {}
+
+	def current(self, pool, db):
+		#a shard's version, read again at most once a second, background migrations may be
+		#running in another process and an offline import takes it back down
+		version = self.version.get(pool.database, 0)
+		checked = self.checked.get(pool.database)
+		if checked is None or time.monotonic() - checked >= 1:
+			self.checked[pool.database] = time.monotonic()
+			version = self.version[pool.database] = db.execute("PRAGMA user_version;").fetchone()[0]
+		return version
+
+	def applied(self, migration, pool, db):
+		return self.current(pool, db) >= self.versions[migration]
+
+	def run(self, pool, background=False):
+		#brings a shard up to date or, with background, up to the first migration which
+		#can wait and returns those left for finish. Uses a connection of its own and
+		#closes it, the server may be about to fork.
+		db = pool.connect()
+		def write(step):
+			try:
+				result = step(db)
+				db.commit()
+			except:
+				db.rollback()
+				raise
+			return result
+		try:
+			version = db.execute("PRAGMA user_version;").fetchone()[0]
+			if version > self.latest:
+				raise RuntimeError("Database schema version %d is newer than this server's %d." % (version, self.latest))
+			self.version[pool.database] = version
+			pending = list(range(version + 1, self.latest + 1))
+			while pending and not (background and self.steps[pending[0] - 1][2]):
+				if not self.migrate(pool, pending.pop(0), write):
+					return []
+			return pending
+		finally:
+			db.close()
+
+	def migrate(self, pool, version, write=None):
+		(description, migration, background) = self.steps[version - 1]
+		write = write or pool.write
+		print("Migrating %s to version %d, %s." % (pool.database, version, description))
+		def step(db):
+			if not db.in_transaction:
+				db.execute("BEGIN")
+			done = migration(db)
+			if done:
+				db.execute("PRAGMA user_version = %d" % version)
+			return done
+		while True:
+			done = write(step)
+			if done is None:
+				return False
+			if done:
+				self.version[pool.database] = version
+				return True
+
+	def finish(self, pending):
+		#the rest for each (pool, versions), through this process's writers
+		start = time.perf_counter()
+		try:
+			for (pool, versions) in pending:
+				for version in versions:
+					if not self.migrate(pool, version):
+						break
+		except Exception:
+			log.log(traceback.format_exc())
+			return
+		print("Background migrations done in %.1fs." % (time.perf_counter() - start))
+
+def defer_indexes(db):
+	#drops every index on the table and the search index with its triggers, so a bulk
+	#load only appends, and takes the schema version back to match. Migrating builds them
+	#again and clears out any dupes on the way, should the load die part way the server
+	#does the same when it next starts.
+	names = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='phonebook' AND sql IS NOT NULL;")]
+	db.executescript("BEGIN;\n" + "".join("DROP INDEX %s;\n" % name for name in names) + '''DROP TRIGGER IF EXISTS phonebook_fts_insert;
+DROP TRIGGER IF EXISTS phonebook_fts_delete;
+DROP TRIGGER IF EXISTS phonebook_fts_update;
+DROP TABLE IF EXISTS phonebook_fts;
+DROP TABLE IF EXISTS phonebook_fts_progress;
+PRAGMA user_version = %d;
+COMMIT;''' % (migrations.versions[index_entries] - 1))
+
+def transfer(args):
+	#the import, export and rebalance commands, with progress on stderr
+	parser = argparse.ArgumentParser(prog="phonebookd.py", description="Bulk import and export of the phone book.")
+	commands = parser.add_subparsers(dest="command", required=True)
+	command = commands.add_parser("import", help="add entries from NDJSON or CSV")
+	command.add_argument("file", nargs="?", default="-", help="file to read, - for stdin")
+	command.add_argument("--format", choices=PhoneBook.FORMATS, help="defaults to csv for .csv files and ndjson otherwise")
+	command.add_argument("--offline", action="store_true",
+		help="drop the indexes and build them again afterwards, faster but only with no server running on the database")
+	command = commands.add_parser("export", help="write every entry as NDJSON or CSV")
+	command.add_argument("file", nargs="?", default="-", help="file to write, - for stdout")
+	command.add_argument("--format", choices=PhoneBook.FORMATS, help="defaults to csv for .csv files and ndjson otherwise")
+	command = commands.add_parser("rebalance", help="move the entries from any other number of shards into these, with the server stopped")
+	command.add_argument("--shards", type=int, default=SHARDS, help="how many shards to end up with, defaults to PHONE_BOOK_SHARDS")
+	args = parser.parse_args(args)
+
+	shown = [0]
+	def progress(rows, seconds):
+		if seconds - shown[0] >= 1:
+			shown[0] = seconds
+			print("%d rows, %d rows/s" % (rows, rows / seconds), file=sys.stderr)
+
+	if args.command == "rebalance":
+		if args.shards < 1:
+			parser.error("--shards must be at least 1")
+		return rebalance(Shards(DATABASE, args.shards, 1), progress)
+	check_shards()
+	format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+	with contextlib.ExitStack() as stack:
+		dbs = []
+		for pool in shards.pools:
+			dbs.append(pool.connect())
+			stack.callback(dbs[-1].close)
+		def count():
+			return sum(db.execute("SELECT COUNT(*) FROM phonebook;").fetchone()[0] for db in dbs)
+		with contextlib.redirect_stdout(sys.stderr):
+			for pool in shards.pools:
+				migrations.run(pool)
+		if args.command == "export":
+			start = time.perf_counter()
+			total = count()
+			out = sys.stdout.buffer if args.file == "-" else stack.enter_context(open(args.file, "wb"))
+			for chunk in PhoneBook.dump(format, progress):
+				out.write(chunk)
+			seconds = time.perf_counter() - start
+			print("Exported %d rows in %.1fs, %d rows/s" % (total, seconds, total / seconds if seconds else 0), file=sys.stderr)
+			return 0
+
+		before = count()
+		if args.offline:
+			for db in dbs:
+				defer_indexes(db)
+		lines = sys.stdin if args.file == "-" else stack.enter_context(open(args.file, encoding="utf-8", newline=""))
+		report = PhoneBook.load(PhoneBook.read_entries(lines, format), progress)
+		if args.offline:
+			start = time.perf_counter()
+			with contextlib.redirect_stdout(sys.stderr):
+				for pool in shards.pools:
+					migrations.run(pool)
+			print("Indexed in %.1fs" % (time.perf_counter() - start), file=sys.stderr)
+			report["imported"] = count() - before
+			report["duplicates"] = report["read"] - report["invalid"] - report["imported"]
+		for error in report.pop("errors"):
+			print("Entry %d: %s" % (error["entry"], error["error"]), file=sys.stderr)
+		print("Imported %(imported)d of %(read)d rows in %(seconds).1fs, %(rows_per_sec)d rows/s, %(duplicates)d duplicates, %(invalid)d invalid" % report,
+			file=sys.stderr)
+		return 0
+
+def check_shards():
+	#entries left in files from another number of shards would be missing from every answer
+	strays = shards.strays()
+	if strays:
+		raise SystemExit("%s from another number of shards, run phonebookd.py rebalance to move their entries into %d." % (", ".join(strays), shards.count))
+
+def check_country_code(db, database):
+	#lookups normalise the numbers asked for with the configured code, which would never
+	#match a column built with another
+	built = country_code(db)
+	if built and built != COUNTRY_CODE:
+		raise SystemExit("%s normalises numbers with country code %s, not %s, set PHONE_BOOK_COUNTRY_CODE=%s or export and import the entries into a new database." % (database, built, COUNTRY_CODE, built))
+
+def rebalance(target, progress):
+	#copies every entry from other numbers of shards into the target's shards, which only
+	#have their table until the copy is done so it only appends, then migrates them and
+	#deletes the old files. Their change logs go with them, entries kept aside as dupes
+	#are copied too. A rebalance which dies part way
+	#leaves the old files be and can be run again, migrating clears out any dupes.
+	sources = target.strays()
+	if not sources:
+		print("Nothing to rebalance into %d shards." % target.count, file=sys.stderr)
+		return 0
+	start = time.perf_counter()
+	copied = 0
+	with contextlib.ExitStack() as stack:
+		dbs = []
+		for pool in target.pools:
+			dbs.append(pool.connect())
+			stack.callback(dbs[-1].close)
+			if not schema_has(dbs[-1], "table", "phonebook"):
+				create_table(dbs[-1])
+				dbs[-1].execute("PRAGMA user_version = %d" % migrations.versions[create_table])
+				dbs[-1].commit()
+		for path in sources:
+			print("Copying from %s." % path, file=sys.stderr)
+			source = ConnectionPool(path, 1).connect()
+			try:
+				if not schema_has(source, "table", "phonebook"):
+					continue
+				for rows in PhoneBook.batches(source.execute("SELECT surname, firstname, number, address FROM phonebook ORDER BY rowid ASC;")):
+					parts = [[] for db in dbs]
+					for row in rows:
+						parts[target.owner(row[0])].append(row)
+					for (db, part) in zip(dbs, parts):
+						if part:
+							PhoneBook.insert_many(db, part)
+					copied += len(rows)
+					progress(copied, time.perf_counter() - start)
+				if schema_has(source, "table", "phonebook_dupes"):
+					for row in source.execute("SELECT surname, firstname, number, address, index_name FROM phonebook_dupes ORDER BY rowid ASC;").fetchall():
+						db = dbs[target.owner(row[0])]
+						db.execute(DUPES_TABLE)
+						db.execute("INSERT INTO phonebook_dupes VALUES (?, ?, ?, ?, ?)", row)
+				for db in dbs:
+					db.commit()
+			finally:
+				source.close()
+	with contextlib.redirect_stdout(sys.stderr):
+		for pool in target.pools:
+			migrations.run(pool)
+	for path in sources:
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+	seconds = time.perf_counter() - start
+	print("Rebalanced %d rows from %d files into %d shards in %.1fs, %d rows/s" % (copied, len(sources), target.count, seconds, copied / seconds if seconds else 0),
+		file=sys.stderr)
+	return 0
+
+shards = Shards(DATABASE, SHARDS, POOL_SIZE)
+cache = ResponseCache(CACHE_SIZE)
+metrics = Metrics()
+log = RequestLog(LOG_SAMPLE)
+profiler = Profiler(PROFILE_SAMPLE)
+slow = SlowQueries(SLOW_QUERY_MS / 1000, MAX_SLOW)
+replica = Replica(DATABASE, REPLICA_POLL)
+suggestions = [Suggestions(pool) for pool in shards.pools]
+feed = ChangeFeed(CHANGES_POLL, MAX_WAITERS)
+
+migrations = Migrations(MIGRATIONS)
+
+def main():
+	#everything which touches the database or the network waits for here, so importing
+	#the module only defines things
+	start = time.perf_counter()
+	if sys.argv[1:2] in (["import"], ["export"], ["rebalance"]):
+		sys.exit(transfer(sys.argv[1:]))
+
+	pending = []
+	if REPLICA:
+		#the schema belongs to whoever writes the database, forked workers load their own snapshots
+		if SHARDS > 1:
+			raise SystemExit("A replica serves a single database, not shards.")
+		if os.path.exists(DATABASE):
+			with contextlib.closing(replica.connect()) as db:
+				check_country_code(db, DATABASE)
+		if not MODE in ("prefork", "reuseport"):
+			replica.start()
+			signal.signal(signal.SIGHUP, replica.hangup)
+	else:
+		print("SQLite version: " + sqlite3.sqlite_version)
+		check_shards()
+		pending = [(pool, migrations.run(pool, background=True)) for pool in shards.pools]
+		pending = [(pool, versions) for (pool, versions) in pending if versions]
+		for pool in shards.pools:
+			with contextlib.closing(pool.connect()) as db:
+				check_country_code(db, pool.database)
+		if SHARDS > 1:
+			print("Split across %d shards." % SHARDS)
+		print("Schema at version %d of %d." % (min(migrations.version.values()), migrations.latest))
+
+	if not MODE in ("prefork", "reuseport"):
+		shards.map(lambda shard: suggestions[shard].start())
+
+	#not protected from stray packets in test mode
+	if os.getenv('PHONE_BOOK_TEST'):
+		socketserver.TCPServer.allow_reuse_address = True
+
+	if MODE == "threaded":
+		httpd = ThreadPoolTCPServer((HOST, PORT), PhoneBookHTTPHandler, WORKERS)
+	elif MODE == "asyncio":
+		httpd = AsyncPhoneBookServer((HOST, PORT), WORKERS)
+	elif MODE != "reuseport":
+		#prefork children inherit the listening socket and take turns to accept on it
+		httpd = KeepAliveTCPServer((HOST, PORT), PhoneBookHTTPHandler)
+	print("Serving in %s mode with %s durability, started in %.3fs." % (MODE, DURABILITY, time.perf_counter() - start))
+	background = (lambda: migrations.finish(pending)) if pending else None
+	if MODE == "prefork":
+		Supervisor(WORKERS, lambda: httpd, background).run()
+	elif MODE == "reuseport":
+		Supervisor(WORKERS, lambda: ReusePortTCPServer((HOST, PORT), PhoneBookHTTPHandler), background).run()
+	else:
+		if background:
+			daemon(background)
+		httpd.serve_forever()
 
-httpd = socketserver.TCPServer((HOST, PORT), PhoneBookHTTPHandler)
-httpd.serve_forever()
+if __name__ == '__main__':
+	main()